@@ -0,0 +1,665 @@
+"""オフラインのベンチマーク
+
+実機・LAN・Discord を使わずに、main.py のコマンドハンドラを実際に呼び出して性能を測定する。
+
+- ゲーム用PCの代わりに、ローカルの asyncssh サーバーと WoL 受信ポート、死活応答を持つ偽ホストを起動する
+- discord.Interaction の代わりに、送信・編集を記録するだけのスタブを渡す
+- N 人が同時にコマンドを実行したときのスループットと応答時間を表示する
+
+使い方:
+    python bench.py --users 5 --rounds 3 --boot-delay 3 --scenarios start,stats,gsm,stop,reboot
+"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import shutil
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import asyncssh
+
+
+# ==============================================================================
+# 偽ホスト
+# ==============================================================================
+
+class FakeHost:
+    """電源状態を持つ偽のゲーム用PC
+
+    WoL のマジックパケットを受け取ると boot_delay 秒後に死活応答を返し始め、さらに ssh_delay 秒後に
+    SSH 接続を受け付ける。poweroff / reboot を受け取ると shutdown_delay 秒後に全接続を切断して応答を止める。
+    """
+    def __init__(self, mac: str, boot_delay: float, shutdown_delay: float, ssh_delay: float, command_delay: float):
+        self.mac = bytes.fromhex(mac.replace(":", ""))
+        self.boot_delay = boot_delay
+        self.shutdown_delay = shutdown_delay
+        self.ssh_delay = ssh_delay
+        self.command_delay = command_delay
+        self.ssh_port = 0
+        self.wol_port = 0
+        self.powered = False
+        self.boot_id = uuid.uuid4()
+        self.games_root = ""
+        self.games: Dict[str, Any] = {}
+        self.counters = {"connections": 0, "commands": 0, "wol": 0, "boots": 0}
+        self._server = None
+        self._connections: set = set()
+        self._transition: Optional[asyncio.Task] = None
+        self._key = None
+
+    # ---- 電源 ----------------------------------------------------------------
+
+    async def start(self, powered: bool):
+        """SSH と WoL のポートを確保する"""
+        self._key = asyncssh.generate_private_key("ssh-ed25519")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.ssh_port = s.getsockname()[1]
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _WolProtocol(self), local_addr=("127.0.0.1", 0))
+        self.wol_port = transport.get_extra_info("sockname")[1]
+        await self.set_power(powered)
+
+    async def set_power(self, powered: bool):
+        """遅延なしで電源状態を切り替える（シナリオの前提条件を整える用）"""
+        if self._transition:
+            self._transition.cancel()
+            self._transition = None
+        if powered:
+            self.powered = True
+            await self._listen()
+        else:
+            self._shutdown()
+
+    async def _listen(self):
+        if self._server is None:
+            self._server = await asyncssh.create_server(
+                lambda: FakeSSHServer(self), "127.0.0.1", self.ssh_port,
+                server_host_keys=[self._key], process_factory=self._handle, reuse_address=True,
+            )
+
+    def _shutdown(self):
+        self.powered = False
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for conn in list(self._connections):
+            conn.abort()
+        self._connections.clear()
+        for server_id in list(self.games):
+            self.stop_game(server_id)
+
+    # ---- ゲームサーバー ----------------------------------------------------------
+
+    async def start_game(self, server_id: str):
+        """サーバーのディレクトリで待機するだけのプロセスを起動する（メトリクス収集で稼働中と判定される）
+
+        tmux があれば LinuxGSM と同じく tmux セッション上で動かし、起動済みのサーバーへの /start が省略されるようにする。
+        """
+        if server_id not in self.games:
+            path = os.path.join(self.games_root, server_id)
+            os.makedirs(path, exist_ok=True)
+            if shutil.which("tmux"):
+                session = f"bench-{server_id}"
+                proc = await asyncio.create_subprocess_exec("tmux", "new-session", "-d", "-s", session, "-c", path, "sleep 3600")
+                await proc.wait()
+                self.games[server_id] = session
+            else:
+                self.games[server_id] = await asyncio.create_subprocess_exec("sleep", "3600", cwd=path)
+
+    def stop_game(self, server_id: str):
+        game = self.games.pop(server_id, None)
+        if isinstance(game, str):
+            subprocess.run(["tmux", "kill-session", "-t", game], capture_output=True)
+        elif game and game.returncode is None:
+            game.kill()
+
+    def wake(self):
+        if not self.powered and self._transition is None:
+            self.counters["boots"] += 1
+            self._transition = asyncio.create_task(self._boot())
+
+    async def _boot(self):
+        await asyncio.sleep(self.boot_delay)
+        self.boot_id = uuid.uuid4()
+        self.powered = True
+        await asyncio.sleep(self.ssh_delay)
+        await self._listen()
+        self._transition = None
+
+    def power_off(self, reboot: bool = False):
+        if self._transition is None:
+            self._transition = asyncio.create_task(self._power_off(reboot))
+
+    async def _power_off(self, reboot: bool):
+        await asyncio.sleep(self.shutdown_delay)
+        self._shutdown()
+        self._transition = None
+        if reboot:
+            self.wake()
+
+    async def ping(self) -> bool:
+        """死活応答（HostMonitor のプローブの代わり）"""
+        await asyncio.sleep(0.001)
+        return self.powered
+
+    # ---- コマンド --------------------------------------------------------------
+
+    async def _handle(self, process):
+        self.counters["commands"] += 1
+        command = process.command or ""
+        status = 0
+        try:
+            if command.startswith("python3 -"):
+                await self._run_agent(process, command)
+            elif command in ("sudo poweroff", "sudo reboot"):
+                self.power_off(reboot=command.endswith("reboot"))
+            elif command == "cat /proc/sys/kernel/random/boot_id":
+                process.stdout.write(f"{self.boot_id}\n")
+            elif command.startswith(("test -e", "echo ")):
+                process.stdout.write("ok\n")
+            elif command.startswith("bash -c "):
+                status = await self._run_local(process, command)
+            elif command.startswith(self.games_root) and command.endswith((" start", " stop")):
+                await asyncio.sleep(self.command_delay)
+                server_id = os.path.relpath(command.split()[0], self.games_root).split(os.sep)[0]
+                if command.endswith(" start"):
+                    await self.start_game(server_id)
+                else:
+                    self.stop_game(server_id)
+                process.stdout.write(f"[  OK  ] {command}\n")
+            else:
+                # ゲームスクリプトなどは少しずつ出力しながら command_delay 秒かかる
+                for i in range(5):
+                    await asyncio.sleep(self.command_delay / 5)
+                    process.stdout.write(f"[ .... ] {command} ({i + 1}/5)\n")
+            process.exit(status)
+        except (OSError, asyncio.CancelledError):
+            process.close()
+
+    async def _run_local(self, process, command: str) -> int:
+        # バックアップなどのシェルスクリプトはローカルでそのまま実行し、出力を流す
+        proc = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        async for line in proc.stdout:
+            process.stdout.write(line.decode())
+        return await proc.wait()
+
+    async def _run_agent(self, process, command: str):
+        # メトリクス収集スクリプトはローカルの python3 でそのまま実行する
+        script = await process.stdin.read()
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-", *shlex.split(command)[2:],
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        out, _ = await proc.communicate(script.encode())
+        process.stdout.write(out.decode())
+
+
+class FakeSSHServer(asyncssh.SSHServer):
+    """認証なしで接続を受け付け、電源断の際に切断できるよう接続を登録する"""
+    def __init__(self, host: FakeHost):
+        self.host = host
+
+    def connection_made(self, conn):
+        self.host.counters["connections"] += 1
+        self.host._connections.add(conn)
+
+    def begin_auth(self, username: str) -> bool:
+        return False
+
+
+class _WolProtocol(asyncio.DatagramProtocol):
+    def __init__(self, host: FakeHost):
+        self.host = host
+
+    def datagram_received(self, data: bytes, addr):
+        if data[:6] == b"\xff" * 6 and data[6:] == self.host.mac * 16:
+            self.host.counters["wol"] += 1
+            self.host.wake()
+
+
+# ==============================================================================
+# 偽ゲームサーバー
+# ==============================================================================
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+async def _read_varint(reader: asyncio.StreamReader) -> int:
+    value = 0
+    for shift in range(0, 35, 7):
+        byte = (await reader.readexactly(1))[0]
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value
+    raise ValueError("VarInt が長すぎます")
+
+
+class FakeGameServer:
+    """Minecraft SLP・A2S_INFO・RCON に応答し、決まったプレイヤーを返す偽のゲームサーバー
+
+    GameQuery の解析結果を expected() と比べることで、3 方式の問い合わせを実機なしで確認する。
+    """
+    def __init__(self, names: List[str], max_players: int, version: str, password: str):
+        self.names = names
+        self.max_players = max_players
+        self.version = version
+        self.password = password
+        self.ports: Dict[str, int] = {}
+        self.counters = {"minecraft": 0, "a2s": 0, "rcon": 0}
+
+    async def start(self) -> Dict[str, int]:
+        loop = asyncio.get_running_loop()
+        minecraft = await asyncio.start_server(self._minecraft, "127.0.0.1", 0)
+        rcon = await asyncio.start_server(self._rcon, "127.0.0.1", 0)
+        transport, _ = await loop.create_datagram_endpoint(lambda: _A2SProtocol(self), local_addr=("127.0.0.1", 0))
+        self.ports = {
+            "minecraft": minecraft.sockets[0].getsockname()[1],
+            "a2s": transport.get_extra_info("sockname")[1],
+            "rcon": rcon.sockets[0].getsockname()[1],
+        }
+        return self.ports
+
+    def expected(self, kind: str) -> Dict[str, Any]:
+        """各方式で GameQuery が返すべき値"""
+        if kind == "minecraft":
+            return {"players": len(self.names), "max_players": self.max_players, "names": self.names, "version": self.version}
+        if kind == "a2s":
+            return {"players": len(self.names), "max_players": self.max_players, "version": self.version}
+        return {"players": len(self.names), "names": self.names}
+
+    async def _minecraft(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readexactly(await _read_varint(reader))  # ハンドシェイク
+            await reader.readexactly(await _read_varint(reader))  # ステータス要求
+            self.counters["minecraft"] += 1
+            status = json.dumps({
+                "version": {"name": self.version, "protocol": 767},
+                "players": {"online": len(self.names), "max": self.max_players, "sample": [{"name": n, "id": str(uuid.uuid4())} for n in self.names]},
+                "description": {"text": "bench"},
+            }).encode()
+            payload = _varint(0) + _varint(len(status)) + status
+            writer.write(_varint(len(payload)) + payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _rcon(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def packet(request_id: int, kind: int, body: str) -> bytes:
+            payload = struct.pack("<ii", request_id, kind) + body.encode() + b"\x00\x00"
+            return struct.pack("<i", len(payload)) + payload
+
+        try:
+            while True:
+                size = struct.unpack("<i", await reader.readexactly(4))[0]
+                request_id, kind = struct.unpack("<ii", await reader.readexactly(8))
+                body = (await reader.readexactly(size - 8))[:-2].decode()
+                if kind == 3:
+                    # srcds と同じく、認証応答の前に空の RESPONSE_VALUE を返す
+                    self.counters["rcon"] += 1
+                    writer.write(packet(request_id, 0, "") + packet(request_id if body == self.password else -1, 2, ""))
+                else:
+                    rows = "".join(f"{n},{1000 + i},7656119{i:010d}\n" for i, n in enumerate(self.names))
+                    writer.write(packet(request_id, 0, "name,playeruid,steamid\n" + rows))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class _A2SProtocol(asyncio.DatagramProtocol):
+    """チャレンジ応答付きの A2S_INFO"""
+    challenge = b"\x12\x34\x56\x78"
+
+    def __init__(self, server: FakeGameServer):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        request = b"\xFF\xFF\xFF\xFFTSource Engine Query\x00"
+        if not data.startswith(request):
+            return
+        if data[len(request):] != self.challenge:
+            self.transport.sendto(b"\xFF\xFF\xFF\xFFA" + self.challenge, addr)
+            return
+        self.server.counters["a2s"] += 1
+        server = self.server
+        info = (
+            b"\xFF\xFF\xFF\xFFI\x11" + b"bench\x00map\x00folder\x00Bench Game\x00"
+            + struct.pack("<HBBBcc??", 4020, len(server.names), server.max_players, 0, b"d", b"l", False, False)
+            + server.version.encode() + b"\x00"
+        )
+        self.transport.sendto(info, addr)
+
+
+# ==============================================================================
+# Discord スタブ
+# ==============================================================================
+
+class StubMessage:
+    _ids = 0
+
+    def __init__(self, interaction: "StubInteraction", embed, webhook: bool = True):
+        StubMessage._ids += 1
+        self.id = StubMessage._ids
+        self.channel = type("Channel", (), {"id": 0})()
+        # フォローアップは実際と同じくインタラクションごとの Webhook ルート、チャンネルへの投稿はチャンネルのルートに属する
+        token = f"interaction-{id(interaction)}"
+        self._state = SimpleNamespace(_webhook=SimpleNamespace(id=0, token=token) if webhook else None)
+        self.interaction = interaction
+        self.interaction.record(embed)
+
+    async def edit(self, embed=None, **kwargs):
+        self.interaction.record(embed)
+        return self
+
+
+class StubResponse:
+    def __init__(self, interaction: "StubInteraction"):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, embed=None, **kwargs):
+        self._done = True
+        self.interaction.record(embed)
+
+
+class StubFollowup:
+    def __init__(self, interaction: "StubInteraction"):
+        self.interaction = interaction
+
+    async def send(self, embed=None, embeds=None, **kwargs):
+        return StubMessage(self.interaction, embed or (embeds or [None])[0])
+
+
+class StubChannel:
+    def __init__(self, interaction: "StubInteraction"):
+        self.interaction = interaction
+
+    async def send(self, embed=None, **kwargs):
+        return StubMessage(self.interaction, embed, webhook=False)
+
+
+class StubInteraction:
+    """送信・編集された Embed のタイトルだけを記録する discord.Interaction の代わり"""
+    def __init__(self, user_id: int):
+        self.user = type("User", (), {"id": user_id, "display_name": f"user{user_id}"})()
+        self.response = StubResponse(self)
+        self.followup = StubFollowup(self)
+        self.channel = StubChannel(self)
+        self.titles: List[str] = []
+        self.api_calls = 0
+
+    def record(self, embed):
+        self.api_calls += 1
+        if embed is not None:
+            self.titles.append(embed.title or "")
+
+    async def edit_original_response(self, embed=None, **kwargs):
+        self.record(embed)
+
+    @property
+    def failed(self) -> bool:
+        return any(t.startswith((":x:", ":warning:")) for t in self.titles)
+
+
+# ==============================================================================
+# シナリオ
+# ==============================================================================
+
+class Bench:
+    def __init__(self, m, fake: FakeHost, game: FakeGameServer, users: int, rounds: int, verbose: bool = False):
+        self.m = m
+        self.game = game
+        self.verbose = verbose
+        self.fake = fake
+        self.users = users
+        self.rounds = rounds
+        gsm = [p["id"] for p in m.profile_registry.profiles() if p.get("gsm")]
+        self.servers = gsm or [p["id"] for p in m.profile_registry.profiles()]
+
+    def server_for(self, user: int) -> str:
+        return self.servers[user % len(self.servers)]
+
+    async def prepare(self, powered: bool, running: bool):
+        """電源とサーバー状態を整え、死活監視のキャッシュを捨てる"""
+        await self.fake.set_power(powered)
+        self.m.server_states.clear()
+        for server in self.servers:
+            if running:
+                await self.fake.start_game(server)
+                self.m.server_states[server] = True
+            else:
+                self.fake.stop_game(server)
+        for host in self.m.hosts.values():
+            host.monitor.checked_at = 0.0
+            await host.monitor.check(max_age=0)
+            metrics = await host.metrics.collect(host.server_dirs()) if powered else None
+            self.m.status_cache.update(host.name, metrics, time.monotonic())
+
+    async def scenario_start(self, user: int, i: StubInteraction):
+        await self.m.manage_server(i, [self.server_for(user)], "start")
+
+    async def scenario_start_running(self, user: int, i: StubInteraction):
+        await self.m.manage_server(i, [self.server_for(user)], "start")
+
+    async def scenario_stop(self, user: int, i: StubInteraction):
+        await self.m.on_stop.callback(i, self.server_for(user))
+
+    async def scenario_status(self, user: int, i: StubInteraction):
+        await self.m.on_status.callback(i)
+
+    async def scenario_stats(self, user: int, i: StubInteraction):
+        await self.m.on_stats.callback(i)
+
+    async def scenario_gsm(self, user: int, i: StubInteraction):
+        await self.m.on_gsm.callback(i, self.server_for(user), "details")
+
+    async def scenario_backup(self, user: int, i: StubInteraction):
+        await self.m.on_backup.callback(i, self.server_for(user))
+
+    async def scenario_players(self, user: int, i: StubInteraction):
+        await self.m.on_players.callback(i)
+        # 各方式の解析結果が偽サーバーの内容と一致しなければエラーとして数える
+        for profile in self.m.profile_registry.profiles():
+            query = profile["info"].get("query")
+            if query is None:
+                continue
+            result = await self.m.game_query.query(profile)
+            actual = {key: getattr(result, key) for key in self.game.expected(query["type"])}
+            if not result.online or actual != self.game.expected(query["type"]):
+                i.titles.append(f":x: {query['type']}: {result.error or actual}")
+
+    async def scenario_reboot(self, user: int, i: StubInteraction):
+        await self.m.on_reboot.callback(i)
+
+    preconditions = {
+        "start": (False, False),
+        "start_running": (True, True),
+        "stop": (True, True),
+        "status": (True, True),
+        "stats": (True, False),
+        "gsm": (True, False),
+        "backup": (True, True),
+        "players": (True, True),
+        "reboot": (True, False),
+    }
+
+    async def run(self, name: str) -> Dict[str, Any]:
+        handler = getattr(self, f"scenario_{name}")
+        latencies: List[float] = []
+        errors = api_calls = 0
+        before = dict(self.fake.counters)
+        pools = [dict(h.remote.pool_stats()) for h in self.m.hosts.values()]
+        wall = 0.0
+        for _ in range(self.rounds):
+            await self.prepare(*self.preconditions[name])
+
+            async def one(user: int):
+                interaction = StubInteraction(user)
+                start = time.perf_counter()
+                await handler(user, interaction)
+                latencies.append(time.perf_counter() - start)
+                return interaction
+
+            started = time.perf_counter()
+            interactions = await asyncio.gather(*[one(u) for u in range(self.users)])
+            wall += time.perf_counter() - started
+            errors += sum(i.failed for i in interactions)
+            if self.verbose:
+                for i in interactions:
+                    print(f"  {name} user{i.user.id}: {' -> '.join(i.titles)}", file=sys.stderr)
+            api_calls += sum(i.api_calls for i in interactions)
+
+        pools_after = [h.remote.pool_stats() for h in self.m.hosts.values()]
+        latencies.sort()
+        ops = len(latencies)
+        return {
+            "scenario": name,
+            "ops": ops,
+            "wall": wall,
+            "throughput": ops / wall if wall else 0.0,
+            "p50": statistics.median(latencies),
+            "p95": latencies[min(ops - 1, int(ops * 0.95))],
+            "max": latencies[-1],
+            "errors": errors,
+            "discord_calls": api_calls,
+            "ssh_connects": sum(a["connects"] - b["connects"] for a, b in zip(pools_after, pools)),
+            "ssh_commands": self.fake.counters["commands"] - before["commands"],
+            "wol": self.fake.counters["wol"] - before["wol"],
+        }
+
+
+def format_report(args: argparse.Namespace, results: List[Dict[str, Any]], perf) -> str:
+    lines = [
+        f"users={args.users} rounds={args.rounds} boot_delay={args.boot_delay}s ssh_delay={args.ssh_delay}s "
+        f"shutdown_delay={args.shutdown_delay}s command_delay={args.command_delay}s",
+        "",
+        f"{'scenario':<13} {'ops':>4} {'wall(s)':>8} {'ops/s':>7} {'p50(s)':>8} {'p95(s)':>8} {'max(s)':>8} "
+        f"{'err':>4} {'discord':>7} {'ssh_conn':>8} {'ssh_cmd':>7} {'wol':>4}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r['scenario']:<13} {r['ops']:>4} {r['wall']:>8.2f} {r['throughput']:>7.2f} {r['p50']:>8.3f} {r['p95']:>8.3f} "
+            f"{r['max']:>8.3f} {r['errors']:>4} {r['discord_calls']:>7} {r['ssh_connects']:>8} {r['ssh_commands']:>7} {r['wol']:>4}"
+        )
+    if perf.stages:
+        lines += ["", f"{'stage':<26} {'count':>6} {'mean(s)':>8} {'p50(s)':>8} {'p95(s)':>8} {'max(s)':>8}"]
+        for stage, h in sorted(perf.stages.items()):
+            lines.append(f"{stage:<26} {h.count:>6} {h.total / h.count:>8.3f} {h.quantile(0.5):>8.3f} {h.quantile(0.95):>8.3f} {h.max:>8.3f}")
+    return "\n".join(lines)
+
+
+def write_servers(source: str, dest: str, ports: Dict[str, int], password: str):
+    """サーバー定義をコピーし、先頭から順に3方式の問い合わせ先として偽ゲームサーバーを設定する"""
+    data = json.loads(open(source, encoding="utf-8").read())
+    profiles = data if isinstance(data, list) else data["servers"]
+    for profile, kind in zip(profiles, ports):
+        profile["info"]["query"] = {"type": kind, "host": "127.0.0.1", "port": ports[kind]}
+        if kind == "rcon":
+            profile["info"]["query"]["password"] = password
+    with open(dest, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+async def main(args: argparse.Namespace) -> str:
+    mac = "02:00:00:00:be:ec"
+    fake = FakeHost(mac, args.boot_delay, args.shutdown_delay, args.ssh_delay, args.command_delay)
+    await fake.start(powered=False)
+
+    # main.py は import 時に環境変数と ./servers.json を読むため、作業用ディレクトリを用意してから読み込む
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    fake.games_root = os.path.join(workdir, "games")
+    servers = os.path.abspath(args.servers)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    game = FakeGameServer(["alice", "bob", "carol"], 20, "1.21.1", "bench")
+    ports = await game.start()
+    write_servers(servers, os.path.join(workdir, "servers.json"), ports, game.password)
+    os.environ.update({
+        "SSH_HOST": "127.0.0.1", "SSH_PORT": str(fake.ssh_port), "SSH_USER": "bench",
+        "TARGET_MAC": mac, "BROADCAST_IP": "127.0.0.1", "WOL_PORT": str(fake.wol_port),
+        "PUBLIC_HOSTNAME": "bench.invalid", "STATE_DB": os.path.join(workdir, "state.db"),
+        "CACHE_DIR": os.path.join(workdir, ".cache"), "PERF_ENABLED": "1", "IDLE_CHANNEL_ID": "0",
+        "GAMES_ROOT": fake.games_root, "BACKUP_ROOT": os.path.join(workdir, "backups"),
+        # 偽のゲームサーバーの tmux セッションは作業用ディレクトリの専用サーバーで動かす
+        "TMUX_TMPDIR": workdir,
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, repo)
+    try:
+        import main as m
+
+        async def change_presence(**kwargs):
+            pass
+        m.client.change_presence = change_presence
+        await m.state_store.open()
+        for host in m.hosts.values():
+            host.monitor._probe = fake.ping
+            host.start()
+
+        bench = Bench(m, fake, game, args.users, args.rounds, args.verbose)
+        results = []
+        for name in args.scenarios.split(","):
+            print(f"running {name}...", file=sys.stderr)
+            results.append(await bench.run(name.strip()))
+        return format_report(args, results, m.perf)
+    finally:
+        for server_id in list(fake.games):
+            fake.stop_game(server_id)
+        if shutil.which("tmux"):
+            subprocess.run(["tmux", "kill-server"], capture_output=True)
+        os.chdir(repo)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5, help="同時にコマンドを実行するユーザー数")
+    parser.add_argument("--rounds", type=int, default=3, help="各シナリオの繰り返し回数")
+    parser.add_argument("--boot-delay", type=float, default=3.0, help="WoL を受けてから死活応答するまでの秒数")
+    parser.add_argument("--ssh-delay", type=float, default=1.0, help="死活応答してから SSH を受け付けるまでの秒数")
+    parser.add_argument("--shutdown-delay", type=float, default=2.0, help="poweroff/reboot を受けてから停止するまでの秒数")
+    parser.add_argument("--command-delay", type=float, default=0.5, help="ゲームスクリプトの実行にかかる秒数")
+    parser.add_argument("--scenarios", default="start,start_running,status,stats,gsm,backup,players,stop,reboot", help="実行するシナリオ（カンマ区切り）")
+    parser.add_argument("--servers", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "servers.json"), help="使用するサーバー定義")
+    parser.add_argument("--verbose", action="store_true", help="各ユーザーに表示されたメッセージの推移を表示する")
+    parser.add_argument("--output", default="bench_output.txt", help="結果の保存先（空文字で保存しない）")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
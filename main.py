@@ -1,17 +1,36 @@
+import time
+_started_at = time.perf_counter()
 import os
-import platform
-import subprocess
 import re
 import json
+import io
+import struct
+import zlib
+import gzip
+from array import array
+from collections import deque
+import shlex
+import hashlib
+import importlib
+import functools
+import inspect
+import bisect
+import random
+import sqlite3
+import signal
+import uuid
+from contextlib import contextmanager, nullcontext
 import discord
 from discord import app_commands as cmd
-import asyncssh
-from wakeonlan import send_magic_packet
-import time
+import aiohttp
 import asyncio
 from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator, Awaitable, Callable, Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # asyncssh / wakeonlan は読み込みが重いため、実際に使う時点まで import を遅らせる
+    import asyncssh
 
 # ==============================================================================
 # 設定と定数
@@ -19,6 +38,10 @@ from typing import List, Dict, Any, Optional
 
 load_dotenv()
 
+def load_json(path: str) -> Any:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
 @dataclass
 class Config:
     """環境変数から読み込む設定値"""
@@ -28,26 +51,32 @@ class Config:
     ssh_user: str = os.getenv("SSH_USER")
     target_mac: str = os.getenv("TARGET_MAC")
     broadcast_ip: str = os.getenv("BROADCAST_IP")
+    wol_port: int = int(os.getenv("WOL_PORT", 9))
     ping_timeout: int = 120
     ssh_ready_timeout: int = int(os.getenv("SSH_READY_TIMEOUT", 90))
-    global_ip: str = field(init=False)
-
-    def __post_init__(self):
-        public_hostname = os.getenv("PUBLIC_HOSTNAME")
-        if public_hostname:
-            self.global_ip = public_hostname
-        else:
-            try:
-                self.global_ip = subprocess.run(["curl", "-s", "https://api.ipify.org"], capture_output=True, text=True, check=True).stdout.strip()
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                self.global_ip = "取得失敗"
+    games_root: str = os.getenv("GAMES_ROOT", "/home/mame/games")
+    history_interval: int = int(os.getenv("HISTORY_INTERVAL", 10))
+    job_concurrency: int = int(os.getenv("JOB_CONCURRENCY", 3))
+    idle_channel_id: int = int(os.getenv("IDLE_CHANNEL_ID", 0))
+    idle_timeout: int = int(os.getenv("IDLE_TIMEOUT", 1800))
+    idle_grace: int = int(os.getenv("IDLE_GRACE", 300))
+    idle_check_interval: int = int(os.getenv("IDLE_CHECK_INTERVAL", 60))
+    idle_cpu_threshold: float = float(os.getenv("IDLE_CPU_THRESHOLD", 50))
+    backup_root: str = os.getenv("BACKUP_ROOT", "/home/mame/backups")
+    backup_keep: int = int(os.getenv("BACKUP_KEEP", 5))
+    backup_concurrency: int = int(os.getenv("BACKUP_CONCURRENCY", 2))
+    backup_bwlimit: int = int(os.getenv("BACKUP_BWLIMIT", 20))
+    backup_cpu_threshold: float = float(os.getenv("BACKUP_CPU_THRESHOLD", 30))
+    public_hostname: Optional[str] = os.getenv("PUBLIC_HOSTNAME")
+    cache_dir: str = os.getenv("CACHE_DIR", "./.cache")
+    global_ip_ttl: int = 6 * 60 * 60
+    state_db: str = os.getenv("STATE_DB", "./state.db")
+    perf_enabled: bool = os.getenv("PERF_ENABLED", "1") != "0"
+    perf_port: int = int(os.getenv("PERF_PORT", 0))
 
 @dataclass
 class Constants:
     """アプリケーション内で使用する定数"""
-    profiles: List[Dict[str, Any]] = field(default_factory=lambda: json.load(open("./servers.json", "r")))
-    server_choices: List[cmd.Choice] = field(init=False)
-    gsm_server_choices: List[cmd.Choice] = field(init=False)
     action_choices: List[cmd.Choice] = field(init=False)
 
     content_map: Dict[str, Dict[str, Any]] = field(default_factory=lambda: {
@@ -64,15 +93,181 @@ class Constants:
         ["Force Update", "force-update"], ["Validate", "validate"]
     ])
 
+    query_ports: Dict[str, int] = field(default_factory=lambda: {"minecraft": 25565, "a2s": 27015, "rcon": 25575})
+    default_host: Dict[str, Any] = field(default_factory=lambda: {"name": "default", "label": "MAME G.S."})
+    gsm_edit_interval: float = 2.0
+    message_edit_interval: float = 1.0
+    message_edit_rate: int = 5
+    message_edit_per: float = 5.0
+    presence_delay: float = 1.0
+    log_scan_lines: int = 100000
+    log_max_files: int = 5
+    log_follow_interval: float = 3.0
+    log_follow_duration: int = 600
+    log_follow_max_lines: int = 200
+    log_follow_messages: int = 2
+    helper_processes: List[str] = field(default_factory=lambda: [
+        "sh", "bash", "dash", "tar", "gzip", "pigz", "pv", "sha256sum", "nice", "ionice", "find", "xargs",
+        "tail", "grep", "sed", "sort", "cut", "cat", "timeout",
+    ])
+    backup_excludes: List[str] = field(default_factory=lambda: ["lgsm/backup", "lgsm/tmp", "log"])
+    backup_load_window: int = 300
+    backup_max_wait: int = 6 * 60 * 60
+    backup_check_interval: int = 60
+    backup_schedule_choices: List[cmd.Choice] = field(default_factory=lambda: [
+        cmd.Choice(name="今すぐ", value="now"), cmd.Choice(name="低負荷時", value="low_load"),
+    ])
+    history_periods: Dict[str, Dict[str, Any]] = field(default_factory=lambda: {
+        "1h": {"label": "過去1時間", "step": None, "span": 3600},
+        "24h": {"label": "過去24時間", "step": 300, "span": 86400},
+        "7d": {"label": "過去7日間", "step": 1800, "span": 604800},
+    })
+    stats_mode_choices: List[cmd.Choice] = field(default_factory=lambda: [
+        cmd.Choice(name="現在", value="current"), cmd.Choice(name="履歴", value="history"),
+    ])
+    history_period_choices: List[cmd.Choice] = field(default_factory=lambda: [
+        cmd.Choice(name="1時間", value="1h"), cmd.Choice(name="24時間", value="24h"), cmd.Choice(name="7日間", value="7d"),
+    ])
+
     def __post_init__(self):
-        self.server_choices = [cmd.Choice(name=p["name"], value=p["id"]) for p in self.profiles]
-        self.gsm_server_choices = [cmd.Choice(name=p["name"], value=p["id"]) for p in self.profiles if p.get("gsm")]
         self.action_choices = [cmd.Choice(name=a[0], value=a[1]) for a in self.gsm_actions]
 
 
+@dataclass(frozen=True)
+class ProfileSnapshot:
+    """ある時点の servers.json の内容と、その索引"""
+    profiles: List[Dict[str, Any]]
+    host_profiles: List[Dict[str, Any]]
+    by_id: Dict[str, Dict[str, Any]]
+    by_host: Dict[str, List[Dict[str, Any]]]
+    mtime: float
+
+
+class ProfileRegistry:
+    """servers.json のサーバー定義を ID・ホスト別に索引付けして保持するクラス
+
+    ファイルの更新時刻を定期的に確認し、変更があれば別スレッドで読み込み・検証した上で
+    索引ごと差し替える。検証に失敗した場合は以前の内容を使い続ける。
+    """
+    def __init__(self, path: str, default_host: Dict[str, Any], query_types: List[str], interval: float = 2.0):
+        self.path = path
+        self.default_host = default_host
+        self.query_types = query_types
+        self.interval = interval
+        self.listeners: List[Callable[[ProfileSnapshot], Callable[[], None]]] = []
+        self._snapshot = self._load()
+        self._failed_mtime: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _validate(self, data: Any) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """内容を検証し、(サーバー定義, ホスト定義) を返す"""
+        # 旧形式（サーバー定義のリスト）と、ホスト定義を含む新形式の両方を受け付ける
+        if isinstance(data, list):
+            profiles, host_profiles = data, []
+        elif isinstance(data, dict) and isinstance(data.get("servers"), list) and isinstance(data.get("hosts", []), list):
+            profiles, host_profiles = data["servers"], data.get("hosts", [])
+        else:
+            raise ValueError("サーバー定義のリスト、または servers を持つオブジェクトである必要があります")
+
+        if not all(isinstance(h, dict) for h in host_profiles):
+            raise ValueError("ホスト定義はオブジェクトである必要があります")
+        host_names = [h.get("name") for h in host_profiles]
+        if not all(isinstance(name, str) for name in host_names) or len(set(host_names)) != len(host_names):
+            raise ValueError("ホストの name は重複しない文字列である必要があります")
+        seen = set()
+        for p in profiles:
+            if not isinstance(p, dict):
+                raise ValueError(f"サーバー定義はオブジェクトである必要があります: {p}")
+            if not isinstance(p.get("id"), str) or not isinstance(p.get("name"), str):
+                raise ValueError(f"サーバー定義に id/name がありません: {p}")
+            if p["id"] in seen:
+                raise ValueError(f"サーバー ID `{p['id']}` が重複しています")
+            seen.add(p["id"])
+            if not isinstance(p.get("info"), dict):
+                raise ValueError(f"`{p['id']}` に info がありません")
+            if not isinstance(p.get("command", {}), dict):
+                raise ValueError(f"`{p['id']}` の command はオブジェクトである必要があります")
+            if not p.get("gsm") and not {"start", "stop"} <= set(p.get("command", {})):
+                raise ValueError(f"`{p['id']}` は gsm でないため command.start/stop が必要です")
+            if p.get("host") and p["host"] not in host_names:
+                raise ValueError(f"`{p['id']}` のホスト `{p['host']}` が定義されていません")
+            query = p["info"].get("query")
+            if query is not None and not isinstance(query, dict):
+                raise ValueError(f"`{p['id']}` の query はオブジェクトである必要があります")
+            if query is not None and query.get("type") not in self.query_types:
+                raise ValueError(f"`{p['id']}` の問い合わせ方式 `{query.get('type')}` には対応していません")
+        return profiles, host_profiles
+
+    def _load(self) -> ProfileSnapshot:
+        """ファイルを読み込んで索引を構築する（ブロッキング処理）"""
+        mtime = os.stat(self.path).st_mtime
+        profiles, host_profiles = self._validate(load_json(self.path))
+        default_name = (host_profiles or [self.default_host])[0]["name"]
+        by_host: Dict[str, List[Dict[str, Any]]] = {h["name"]: [] for h in host_profiles or [self.default_host]}
+        for p in profiles:
+            by_host[p.get("host") or default_name].append(p)
+        return ProfileSnapshot(profiles, host_profiles, {p["id"]: p for p in profiles}, by_host, mtime)
+
+    @property
+    def snapshot(self) -> ProfileSnapshot:
+        return self._snapshot
+
+    @property
+    def host_profiles(self) -> List[Dict[str, Any]]:
+        return self._snapshot.host_profiles or [self.default_host]
+
+    def profiles(self) -> List[Dict[str, Any]]:
+        return self._snapshot.profiles
+
+    def get(self, server_id: str) -> Optional[Dict[str, Any]]:
+        return self._snapshot.by_id.get(server_id)
+
+    def for_host(self, host_name: str) -> List[Dict[str, Any]]:
+        return self._snapshot.by_host.get(host_name, [])
+
+    async def reload(self) -> bool:
+        """更新されていれば読み込み直す（ファイル操作はすべて別スレッドで行う）
+
+        リスナーは新しい内容から反映の準備（ホストの構築など）を行い、反映する関数を返す。
+        準備がすべて成功した場合だけ内容を差し替え、反映する。
+        """
+        mtime = None
+        try:
+            mtime = (await asyncio.to_thread(os.stat, self.path)).st_mtime
+            if mtime in (self._snapshot.mtime, self._failed_mtime):
+                return False
+            snapshot = await asyncio.to_thread(self._load)
+            commits = [listener(snapshot) for listener in self.listeners]
+        except Exception as e:
+            # 同じ内容で何度もエラーを出さないよう、失敗した更新時刻を覚えておく
+            self._failed_mtime = mtime
+            print(f"servers.json の再読み込みに失敗しました: {e}")
+            return False
+        self._snapshot = snapshot
+        for commit in commits:
+            commit()
+        print(f"servers.json を再読み込みしました（{len(snapshot.profiles)}件）。")
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                # 反映中のエラーで監視自体が止まらないようにする
+                print(f"servers.json の反映に失敗しました: {e}")
+
+    def start(self):
+        """変更の監視を開始"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+
 # グローバルインスタンス
 config = Config()
 constants = Constants()
+profile_registry = ProfileRegistry("./servers.json", constants.default_host, list(constants.query_ports))
 
 # Discord クライアント初期化
 intents = discord.Intents.default()
@@ -83,6 +278,179 @@ tree = cmd.CommandTree(client)
 # ユーティリティ & ヘルパークラス
 # ==============================================================================
 
+ANSI_ESCAPE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
+
+
+class Histogram:
+    """処理時間（秒）を固定のバケットに集計するヒストグラム"""
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float, error: bool = False):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """q 分位点の推定値（該当バケットの上限、最後のバケットなら最大値）"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Timer:
+    __slots__ = ("perf", "stage", "start")
+
+    def __init__(self, perf: "Instrumentation", stage: str):
+        self.perf = perf
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.perf.observe(self.stage, time.perf_counter() - self.start, exc_type is not None)
+
+
+class Instrumentation:
+    """段階ごとの処理時間をヒストグラムに記録する計測レイヤー
+
+    無効時はラッパーが有効フラグを1回確認するだけで元の処理を呼ぶ。
+    """
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.stages: Dict[str, Histogram] = {}
+        self.since = time.time()
+
+    def observe(self, stage: str, seconds: float, error: bool = False):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds, error)
+
+    def timer(self, stage: str):
+        """with ブロックの処理時間を記録するコンテキストマネージャ"""
+        return _Timer(self, stage) if self.enabled else nullcontext()
+
+    def timed(self, stage: str) -> Callable[[Callable], Callable]:
+        """関数（同期・非同期）の処理時間を記録するデコレータ"""
+        def decorator(func: Callable) -> Callable:
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    with _Timer(self, stage):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return func(*args, **kwargs)
+                    with _Timer(self, stage):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def instrument_discord(self):
+        """フォローアップ送信・メッセージ編集など Discord API 呼び出しを計測対象にする"""
+        if not self.enabled:
+            return
+        targets = [
+            (discord.InteractionResponse, "send_message", "discord.response"),
+            (discord.InteractionResponse, "defer", "discord.defer"),
+            (discord.Webhook, "send", "discord.followup"),
+            (discord.WebhookMessage, "edit", "discord.edit"),
+            (discord.Message, "edit", "discord.edit"),
+            (discord.PartialMessage, "edit", "discord.edit"),
+        ]
+        for cls, name, stage in targets:
+            method = cls.__dict__[name]
+            if not getattr(method, "_instrumented", False):
+                wrapped = self.timed(stage)(method)
+                wrapped._instrumented = True
+                setattr(cls, name, wrapped)
+
+    def reset(self):
+        self.stages.clear()
+        self.since = time.time()
+
+    def render_prometheus(self) -> str:
+        """Prometheus のテキスト形式で出力"""
+        labels = [str(b) for b in Histogram.bounds] + ["+Inf"]
+        lines = ["# HELP gamebot_stage_seconds Latency of each stage in seconds", "# TYPE gamebot_stage_seconds histogram"]
+        for stage, h in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, n in zip(labels, h.buckets):
+                cumulative += n
+                lines.append(f'gamebot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'gamebot_stage_seconds_sum{{stage="{stage}"}} {h.total}')
+            lines.append(f'gamebot_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        lines.append("# HELP gamebot_stage_errors_total Stage calls that raised an exception")
+        lines.append("# TYPE gamebot_stage_errors_total counter")
+        for stage, h in sorted(self.stages.items()):
+            lines.append(f'gamebot_stage_errors_total{{stage="{stage}"}} {h.errors}')
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int):
+        """localhost のみで /metrics を公開する"""
+        from aiohttp import web
+
+        async def metrics(request: web.Request) -> web.Response:
+            return web.Response(text=self.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+
+perf = Instrumentation(config.perf_enabled)
+
+
+class OutputBuffer:
+    """コマンド出力を上限付きでメモリに保持するバッファ（超過分は古い行から破棄）"""
+    def __init__(self, max_chars: int = 4 * 1024 * 1024):
+        self.max_chars = max_chars
+        self.lines: deque = deque()
+        self.chars = 0
+        self.dropped = 0
+
+    def append(self, line: str):
+        self.lines.append(line)
+        self.chars += len(line) + 1
+        while self.chars > self.max_chars and len(self.lines) > 1:
+            self.chars -= len(self.lines.popleft()) + 1
+            self.dropped += 1
+
+    def tail(self, max_chars: int) -> str:
+        """末尾から max_chars 文字に収まる行を返す"""
+        out, size = [], 0
+        for line in reversed(self.lines):
+            size += len(line) + 1
+            if size > max_chars:
+                break
+            out.append(line)
+        return "\n".join(reversed(out))
+
+    def text(self) -> str:
+        header = f"（先頭の {self.dropped} 行は省略されました）\n" if self.dropped else ""
+        return header + "\n".join(self.lines)
+
+
 class EmbedHelper:
     """Discord Embed メッセージ生成を補助するクラス"""
     @staticmethod
@@ -110,98 +478,1943 @@ class EmbedHelper:
         return EmbedHelper.create_embed(f":information_source: {title}", description, 0x0000ff)
 
 
+class Backoff:
+    """ジッター付きで確認間隔を徐々に伸ばすバックオフ
+
+    eta（状態が変わるまでの予想秒数）を与えると、それまでは間隔を空け、予想時刻の前後は短い間隔で確認する。
+    """
+    def __init__(self, initial: float = 0.25, factor: float = 1.5, maximum: float = 5.0, jitter: float = 0.2, eta: Optional[float] = None):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.eta = eta
+        self.current = initial
+        self.started = time.monotonic()
+
+    def next(self) -> float:
+        """次の確認までの秒数"""
+        elapsed = time.monotonic() - self.started
+        if self.eta is not None and elapsed < self.eta * 0.8:
+            delay = min(self.maximum, max(self.initial, (self.eta * 0.8 - elapsed) / 2))
+        elif self.eta is not None and elapsed < self.eta * 1.5:
+            delay = self.initial
+        else:
+            delay = self.current
+            self.current = min(self.maximum, self.current * self.factor)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class RouteBucket:
+    """Discord API のルートごとのレート制限を見積もるトークンバケット"""
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.finals_waiting = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.rate and not self.finals_waiting
+
+    async def acquire(self, final: bool):
+        """送信枠を1つ取得する（最終結果が待っている間は進捗の送信を後回しにする）"""
+        if final:
+            self.finals_waiting += 1
+        try:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and (final or not self.finals_waiting):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max((1 - self.tokens) * self.per / self.rate, 0.05))
+        finally:
+            if final:
+                self.finals_waiting -= 1
+
+
+class _PendingEdit:
+    __slots__ = ("kwargs", "final", "waiters", "wake", "last_sent")
+
+    def __init__(self):
+        self.kwargs: Dict[str, Any] = {}
+        self.final = False
+        self.waiters: List[asyncio.Future] = []
+        self.wake = asyncio.Event()
+        self.last_sent = 0.0
+
+
+class MessageEditor:
+    """メッセージの編集をまとめて送信するクラス
+
+    同じメッセージへの連続した編集は最新の内容だけを送り、進捗の更新は一定間隔に間引く。
+    最終結果は間引かず、同じルートで待っている進捗の更新より先に送る。
+    """
+    def __init__(self, interval: float, rate: int, per: float):
+        self.interval = interval
+        self.rate = rate
+        self.per = per
+        self._pending: Dict[int, _PendingEdit] = {}
+        self._buckets: Dict[str, RouteBucket] = {}
+
+    def _bucket(self, message: discord.Message) -> RouteBucket:
+        # フォローアップはインタラクションの Webhook ごと、それ以外はチャンネルごとに制限される
+        webhook = getattr(getattr(message, "_state", None), "_webhook", None)
+        route = f"webhook:{webhook.id}:{webhook.token}" if webhook else f"channel:{message.channel.id}"
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            if len(self._buckets) > 256:
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.idle}
+            bucket = self._buckets[route] = RouteBucket(self.rate, self.per)
+        return bucket
+
+    async def edit(self, message: discord.Message, final: bool = False, **kwargs):
+        """メッセージを編集する（final=True は処理結果など、間引かずに優先して送る更新）"""
+        entry = self._pending.get(message.id)
+        if entry is None:
+            entry = self._pending[message.id] = _PendingEdit()
+            asyncio.create_task(self._run(message, entry))
+        entry.kwargs = kwargs
+        entry.final = entry.final or final
+        future = asyncio.get_running_loop().create_future()
+        entry.waiters.append(future)
+        entry.wake.set()
+        await future
+
+    async def _run(self, message: discord.Message, entry: _PendingEdit):
+        bucket = self._bucket(message)
+        try:
+            while True:
+                delay = entry.last_sent + self.interval - time.monotonic()
+                if not entry.waiters or (not entry.final and delay > 0):
+                    # 間隔が空くまで待ち、その間に届いた編集はまとめる（最終結果が届いたらすぐ進む）
+                    entry.wake.clear()
+                    try:
+                        await asyncio.wait_for(entry.wake.wait(), timeout=max(delay, 0) if entry.waiters else self.interval)
+                    except asyncio.TimeoutError:
+                        if not entry.waiters:
+                            return
+                    continue
+
+                await bucket.acquire(entry.final)
+                kwargs, waiters = entry.kwargs, entry.waiters
+                entry.waiters, entry.final = [], False
+                try:
+                    await message.edit(**kwargs)
+                except Exception as e:
+                    for future in waiters:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for future in waiters:
+                        if not future.done():
+                            future.set_result(None)
+                entry.last_sent = time.monotonic()
+        finally:
+            del self._pending[message.id]
+
+message_editor = MessageEditor(constants.message_edit_interval, constants.message_edit_rate, constants.message_edit_per)
+
+
+class ChartHelper:
+    """外部ライブラリなしで折れ線グラフのPNG画像を生成するクラス"""
+    background = (0x2b, 0x2d, 0x31)
+    grid = (0x40, 0x44, 0x4b)
+
+    @staticmethod
+    def _png(width: int, height: int, pixels: bytearray) -> bytes:
+        def chunk(tag: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+        stride = width * 3
+        raw = b"".join(b"\x00" + pixels[y * stride:(y + 1) * stride] for y in range(height))
+        return (b"\x89PNG\r\n\x1a\n"
+                + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+                + chunk(b"IDAT", zlib.compress(raw, 6))
+                + chunk(b"IEND", b""))
+
+    @staticmethod
+    def line_chart(series: List[Tuple[List[Tuple[float, float]], Tuple[int, int, int]]], start: float, end: float, gap: float, width: int = 640, height: int = 240) -> bytes:
+        """0〜100% の時系列を折れ線で描画する（gap 秒以上離れた点は線で結ばない）"""
+        pixels = bytearray(bytes(ChartHelper.background) * (width * height))
+
+        def plot(x: int, y: int, color: Tuple[int, int, int]):
+            for yy in (y, y + 1):
+                if 0 <= x < width and 0 <= yy < height:
+                    i = (yy * width + x) * 3
+                    pixels[i:i + 3] = bytes(color)
+
+        for pct in (25, 50, 75):
+            y = round((1 - pct / 100) * (height - 2))
+            for x in range(0, width, 4):
+                plot(x, y, ChartHelper.grid)
+
+        span = max(end - start, 1.0)
+        for points, color in series:
+            prev = None
+            for t, v in points:
+                x = round((t - start) / span * (width - 1))
+                y = round((1 - min(max(v, 0.0), 100.0) / 100) * (height - 2))
+                if prev and t - prev[0] <= gap:
+                    steps = max(abs(x - prev[1]), abs(y - prev[2]), 1)
+                    for i in range(steps + 1):
+                        plot(prev[1] + (x - prev[1]) * i // steps, prev[2] + (y - prev[2]) * i // steps, color)
+                else:
+                    plot(x, y, color)
+                prev = (t, x, y)
+        return ChartHelper._png(width, height, pixels)
+
+
 class RemoteClient:
-    """SSH経由でのリモート操作を管理するクラス"""
-    def __init__(self, host: str, port: int, user: str):
+    """SSH経由でのリモート操作を管理するクラス
+
+    認証済みの接続をプールして保持し、各コマンドはその上のチャネルとして多重化する。
+    切断された接続は破棄し、次回利用時に遅延再接続する。
+    """
+    def __init__(self, host: str, port: int, user: str, pool_size: int = 2, max_channels: int = 8, keepalive_interval: int = 15):
         self.host = host
         self.port = port
         self.user = user
-        self.conn_options = {"known_hosts": None}
+        self.pool_size = pool_size
+        self.max_channels = max_channels
+        self.conn_options = {
+            "known_hosts": None,
+            "connect_timeout": 10,
+            "keepalive_interval": keepalive_interval,
+            "keepalive_count_max": 3,
+        }
+        self._pool: List["asyncssh.SSHClientConnection"] = []
+        self._channels: Dict["asyncssh.SSHClientConnection", int] = {}
+        self._connect_lock = asyncio.Lock()
+        self._freed = asyncio.Event()
+        self._counters = {"connects": 0, "evictions": 0, "commands": 0, "retries": 0, "waits": 0}
+
+    def _evict(self, conn: "asyncssh.SSHClientConnection"):
+        """接続をプールから取り除いて閉じる"""
+        if conn in self._channels:
+            self._pool.remove(conn)
+            del self._channels[conn]
+            self._counters["evictions"] += 1
+            self._freed.set()
+        conn.close()
+
+    def _evict_if_closed(self, conn: "asyncssh.SSHClientConnection") -> bool:
+        """切断済みの接続だけをプールから取り除く（同じ接続上の他のチャネルを巻き込まないため）"""
+        if conn.is_closed():
+            self._evict(conn)
+            return True
+        return False
 
-    async def execute(self, command: str) -> str:
+    def _pick(self) -> Optional["asyncssh.SSHClientConnection"]:
+        """空きチャネルのある生存中の接続のうち、最も空いているものを選ぶ"""
+        for conn in [c for c in self._pool if c.is_closed()]:
+            self._evict(conn)
+        free = [c for c in self._pool if self._channels[c] < self.max_channels]
+        return min(free, key=self._channels.get, default=None)
+
+    async def _acquire(self) -> "asyncssh.SSHClientConnection":
+        """チャネルを1つ確保する（全接続が上限に達していれば解放を待つ）"""
+        import asyncssh
+        while True:
+            conn = self._pick()
+            if conn is None and len(self._pool) < self.pool_size:
+                async with self._connect_lock:
+                    conn = self._pick()
+                    if conn is None and len(self._pool) < self.pool_size:
+                        conn = await asyncssh.connect(self.host, port=self.port, username=self.user, **self.conn_options)
+                        self._pool.append(conn)
+                        self._channels[conn] = 0
+                        self._counters["connects"] += 1
+            if conn is not None:
+                self._channels[conn] += 1
+                return conn
+            # サーバー側の MaxSessions を超えてチャネルを開くと拒否されるため、上限内に収まるまで待つ
+            self._counters["waits"] += 1
+            self._freed.clear()
+            await self._freed.wait()
+
+    def _release(self, conn: "asyncssh.SSHClientConnection"):
+        if conn in self._channels:
+            self._channels[conn] -= 1
+            self._freed.set()
+
+    async def _run(self, command: str, **kwargs) -> "asyncssh.SSHCompletedProcess":
+        """プール上の接続でコマンドを実行（チャネルを開けなかった場合は一度だけ再試行）"""
+        import asyncssh
+        for attempt in range(2):
+            conn = await self._acquire()
+            try:
+                self._counters["commands"] += 1
+                result = await conn.run(command, **kwargs)
+                if result.exit_status is None and result.exit_signal is None:
+                    # 共有している接続が切れると、終了コードなしで完了したように返り check=True でも例外にならない
+                    self._evict(conn)
+                    raise asyncssh.ConnectionLost("終了コードを受け取る前に接続が切断されました")
+                return result
+            except asyncssh.ChannelOpenError:
+                # ホスト再起動などで死んだ接続を掴んだ場合はチャネル自体が開けない（生きていれば接続は残す）
+                self._evict_if_closed(conn)
+                if attempt:
+                    raise
+                self._counters["retries"] += 1
+            except (asyncssh.ConnectionLost, asyncssh.DisconnectError, OSError):
+                self._evict_if_closed(conn)
+                raise
+            finally:
+                self._release(conn)
+
+    @perf.timed("ssh.execute")
+    async def execute(self, command: str, input: Optional[str] = None) -> str:
         """リモートコマンドを実行し、標準出力を返す"""
+        import asyncssh
         try:
-            async with asyncssh.connect(self.host, port=self.port, username=self.user, **self.conn_options) as conn:
-                result = await conn.run(command, check=True)
-                return result.stdout.strip() if result.stdout else ""
+            result = await self._run(command, check=True, input=input)
+            return result.stdout.strip() if result.stdout else ""
+        except (asyncssh.ConnectionLost, asyncssh.DisconnectError) as e:
+            # 実行中の切断は、コマンドの失敗と区別できるよう ConnectionResetError で通知する
+            raise ConnectionResetError(f"SSHコマンド実行中に接続が切断されました: {e}")
         except (asyncssh.Error, OSError) as e:
             raise ConnectionError(f"SSHコマンド実行に失敗しました: {e}")
 
+    @perf.timed("ssh.execute")
+    async def execute_bytes(self, command: str) -> bytes:
+        """リモートコマンドを実行し、標準出力をバイト列のまま返す"""
+        import asyncssh
+        try:
+            result = await self._run(command, check=True, encoding=None)
+            return result.stdout or b""
+        except (asyncssh.Error, OSError) as e:
+            raise ConnectionError(f"SSHコマンド実行に失敗しました: {e}")
+
+    async def stream(self, command: str) -> AsyncIterator[str]:
+        """リモートコマンドを実行し、出力（標準エラー出力を含む）を1行ずつ返す"""
+        import asyncssh
+        conn = None
+        try:
+            conn = await self._acquire()
+            self._counters["commands"] += 1
+            # 不正なバイトで接続ごと切断されないよう、バイト列で受け取って行ごとに置換しながら復号する
+            async with conn.create_process(command, stderr=asyncssh.STDOUT, encoding=None) as process:
+                async for line in process.stdout:
+                    yield line.decode("utf-8", errors="replace").rstrip("\n")
+                await process.wait()
+        except (asyncssh.ConnectionLost, asyncssh.DisconnectError, asyncssh.ChannelOpenError, OSError) as e:
+            if conn:
+                self._evict_if_closed(conn)
+            raise ConnectionError(f"SSHコマンド実行に失敗しました: {e}")
+        except asyncssh.Error as e:
+            raise ConnectionError(f"SSHコマンド実行に失敗しました: {e}")
+        finally:
+            if conn:
+                self._release(conn)
+        if process.exit_status is None and process.exit_signal is None:
+            self._evict(conn)
+            raise ConnectionError("終了コードを受け取る前に接続が切断されました")
+        if process.exit_status:
+            raise ConnectionError(f"コマンドが終了コード {process.exit_status} で終了しました")
+
     async def check_path(self, path: str) -> bool:
         """リモートのパスが存在するか確認"""
+        import asyncssh
         try:
-            async with asyncssh.connect(self.host, port=self.port, username=self.user, **self.conn_options) as conn:
-                await conn.run(f"test -e {path}", check=True)
-                return True
+            await self._run(f"test -e {path}", check=True)
+            return True
         except (asyncssh.Error, OSError):
             return False
 
-remote_client = RemoteClient(config.ssh_host, config.ssh_port, config.ssh_user)
+    def pool_stats(self) -> Dict[str, int]:
+        """接続プールの統計情報を返す"""
+        live = [c for c in self._pool if not c.is_closed()]
+        return {
+            "connections": len(live),
+            "channels": sum(self._channels[c] for c in live),
+            **self._counters,
+        }
+
+    async def close(self):
+        """プール内の全接続を閉じる"""
+        for conn in list(self._pool):
+            self._evict(conn)
+
+
+
+
+class HostMonitor:
+    """ホストの死活状態を共有キャッシュで管理するクラス
+
+    SSHポートへのTCP接続で判定するためサブプロセスを起動しない。
+    状態が切り替わると、待機中のタスクをイベントで即座に起こす。
+    """
+    def __init__(self, host: str, port: int, ttl: float = 3.0, interval: float = 15.0, probe_timeout: float = 1.0):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self._backoff: Optional[Backoff] = None
+        self.online: Optional[bool] = None
+        self.checked_at = 0.0
+        self._probe_task: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._waiters = 0
+
+    async def _probe(self) -> bool:
+        """SSHポートへTCP接続を試みる（拒否応答もホストが生きている証拠とみなす）"""
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout=self.probe_timeout)
+        except ConnectionRefusedError:
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    def _update(self, online: bool):
+        self.checked_at = time.monotonic()
+        if online != self.online:
+            self.online = online
+            # 現在のイベントを発火させて待機者を起こし、次の変化用に差し替える
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    async def _refresh(self) -> bool:
+        try:
+            online = await self._probe()
+            self._update(online)
+            return online
+        finally:
+            self._probe_task = None
+
+    async def check(self, max_age: Optional[float] = None) -> bool:
+        """キャッシュが新しければその値を返し、古ければ進行中のプローブを共有して確認する"""
+        max_age = self.ttl if max_age is None else max_age
+        if self.online is not None and time.monotonic() - self.checked_at < max_age:
+            return self.online
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self._probe_task)
+
+    async def wait_for(self, target: bool, timeout: float, eta: Optional[float] = None) -> bool:
+        """目標の状態になるまで待機（状態変化のイベントで起床する）
+
+        待機中の確認間隔は、予想所要時間 eta を元にしたバックオフで決める。
+        """
+        self.start()
+        self._waiters += 1
+        self._backoff = Backoff(eta=eta)
+        self._wake.set()
+
+        async def _wait():
+            while await self.check(max_age=0.2) != target:
+                await self._changed.wait()
+
+        try:
+            await asyncio.wait_for(_wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters -= 1
+
+    async def _run(self):
+        while True:
+            await self.check(max_age=0)
+            # 待機者がいる間だけバックオフしながら高頻度で確認する
+            interval = self._backoff.next() if self._waiters and self._backoff else self.interval
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """バックグラウンド監視を開始"""
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """バックグラウンド監視を停止"""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
 
 
 class DeviceManager:
     """デバイスの電源状態やオンライン状態を管理するクラス"""
-    def __init__(self, host: str, mac: str, broadcast_ip: str, ping_timeout: int):
+    def __init__(self, host: str, mac: str, broadcast_ip: str, ping_timeout: int, monitor: HostMonitor, remote: RemoteClient, wol_port: int = 9):
         self.host = host
         self.mac = mac
         self.broadcast_ip = broadcast_ip
+        self.wol_port = wol_port
+        # WoL から起動完了までの学習済みの所要時間（秒）
+        self.boot_time: Optional[float] = None
         self.ping_timeout = ping_timeout
+        self.monitor = monitor
+        self.remote = remote
 
+    @perf.timed("host.is_online")
     async def is_online(self) -> bool:
-        """ホストがオンラインか非同期で確認"""
-        param = "-n" if platform.system() == "Windows" else "-c"
-        command = ["ping", param, "1", "-w", "1000", self.host] if platform.system() == "Windows" else ["ping", param, "1", "-W", "1", self.host]
-        try:
-            proc = await asyncio.create_subprocess_exec(*command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            await asyncio.wait_for(proc.wait(), timeout=2.0)
-            return proc.returncode == 0
-        except (FileNotFoundError, asyncio.TimeoutError):
-            return False
+        """ホストがオンラインか確認（監視結果のキャッシュを共有）"""
+        return await self.monitor.check()
 
+    @perf.timed("host.send_wol")
     def send_wol(self):
         """WoLマジックパケットを送信"""
-        send_magic_packet(self.mac, ip_address=self.broadcast_ip)
+        from wakeonlan import send_magic_packet
+        send_magic_packet(self.mac, ip_address=self.broadcast_ip, port=self.wol_port)
 
-    async def wait_for_status(self, target_status: bool, timeout: int, interval: int = 5) -> bool:
+    async def wait_for_status(self, target_status: bool, timeout: int) -> bool:
         """ホストが目標の状態（オンライン/オフライン）になるまで待機"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            if await self.is_online() == target_status:
-                return True
-            await asyncio.sleep(interval)
-        return False
+        return await self.monitor.wait_for(target_status, timeout)
 
-    async def wait_for_online(self, interval: int = 5) -> bool:
-        return await self.wait_for_status(True, self.ping_timeout, interval)
+    @perf.timed("host.wait_for_online")
+    async def wait_for_online(self) -> bool:
+        return await self.monitor.wait_for(True, self.ping_timeout, eta=self.boot_time)
 
-    async def wait_for_offline(self, interval: int = 5) -> bool:
-        return await self.wait_for_status(False, self.ping_timeout, interval)
+    @perf.timed("host.wait_for_offline")
+    async def wait_for_offline(self) -> bool:
+        return await self.wait_for_status(False, self.ping_timeout)
 
+    def learn_boot_time(self, seconds: float):
+        """起動にかかった時間を記録する（指数移動平均）"""
+        self.boot_time = seconds if self.boot_time is None else self.boot_time * 0.7 + seconds * 0.3
+
+    @perf.timed("host.wait_for_ssh_ready")
     async def wait_for_ssh_ready(self, timeout: int, path_to_check: Optional[str] = None) -> bool:
-        """SSH接続および任意パスが利用可能になるまで待機"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            check_task = remote_client.check_path(path_to_check) if path_to_check else remote_client.execute("echo ok")
+        """SSH接続および任意パスが利用可能になるまで待機（失敗するたびに確認間隔を伸ばす）"""
+        deadline = time.monotonic() + timeout
+        backoff = Backoff(maximum=3.0)
+        while (remaining := deadline - time.monotonic()) > 0:
+            check_task = self.remote.check_path(path_to_check) if path_to_check else self.remote.execute("echo ok")
+            try:
+                if await asyncio.wait_for(check_task, timeout=min(10, remaining)):
+                    return True
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(min(backoff.next(), max(deadline - time.monotonic(), 0)))
+        return False
+
+    async def boot_id(self) -> str:
+        """起動ごとに変わるカーネルの boot_id を取得"""
+        return await self.remote.execute("cat /proc/sys/kernel/random/boot_id")
+
+    @perf.timed("host.wait_for_reboot")
+    async def wait_for_reboot(self, old_boot_id: str, timeout: float) -> bool:
+        """boot_id が変わる（再起動が完了して SSH で接続できる）まで待機"""
+        deadline = time.monotonic() + timeout
+        backoff = Backoff(eta=self.boot_time)
+        while (remaining := deadline - time.monotonic()) > 0:
             try:
-                if await asyncio.wait_for(check_task, timeout=10):
+                # 落ちている間は SSH 接続を試みず、軽い死活確認だけにする
+                if await self.monitor.check(max_age=0.5) and await asyncio.wait_for(self.boot_id(), timeout=min(5, remaining)) != old_boot_id:
                     return True
             except (ConnectionError, asyncio.TimeoutError):
                 pass
-            await asyncio.sleep(5)
+            await asyncio.sleep(min(backoff.next(), max(deadline - time.monotonic(), 0)))
+        return False
+
+
+# リモートで実行するメトリクス収集スクリプト（標準入力から python3 に渡す）
+METRICS_AGENT = r"""
+import json, os, subprocess, sys, time
+
+opts = json.loads(sys.argv[1]) if len(sys.argv) > 1 else {}
+hz = os.sysconf("SC_CLK_TCK")
+page = os.sysconf("SC_PAGE_SIZE")
+helpers = set(opts.get("helpers", []))
+
+def cpu_times():
+    out = {}
+    with open("/proc/stat") as f:
+        for line in f:
+            if not line.startswith("cpu"):
+                break
+            name, *vals = line.split()
+            vals = [int(v) for v in vals[:8]]
+            out[name] = (sum(vals), vals[3] + vals[4])
+    return out
+
+def net_bytes():
+    rx = tx = 0
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(":", 1)
+            if name.strip() == "lo":
+                continue
+            vals = data.split()
+            rx += int(vals[0])
+            tx += int(vals[8])
+    return rx, tx
+
+def proc_ticks(roots):
+    out = {sid: {} for sid in roots}
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            cwd = os.readlink(f"/proc/{pid}/cwd") + "/"
+            sid = next((s for s, r in roots.items() if cwd.startswith(r)), None)
+            if sid is None:
+                continue
+            with open(f"/proc/{pid}/stat") as f:
+                head, rest = f.read().rsplit(")", 1)
+            # バックアップやシェルなど、サーバーのディレクトリで一時的に動くだけのプロセスは数えない
+            if head.split("(", 1)[1] in helpers:
+                continue
+            fields = rest.split()
+            with open(f"/proc/{pid}/statm") as f:
+                rss = int(f.read().split()[1]) * page
+            out[sid][pid] = (int(fields[11]) + int(fields[12]), rss)
+        except (OSError, IndexError, ValueError):
+            continue
+    return out
+
+def tmux_sessions(roots):
+    # サーバーのディレクトリで動いている（またはサーバーIDと同名の）tmux セッション（LinuxGSM はサーバーを tmux 上で動かす）
+    try:
+        out = subprocess.run(["tmux", "list-panes", "-a", "-F", "#{session_name}\t#{pane_pid}\t#{pane_current_path}"],
+                             capture_output=True, text=True, timeout=2).stdout
+    except (OSError, subprocess.SubprocessError):
+        return {}
+    sessions = {}
+    for line in out.splitlines():
+        try:
+            name, pid, path = line.split("\t", 2)
+            # シェルを開いただけのセッションは除き、サーバー本体を動かしているペインだけを数える
+            with open(f"/proc/{pid}/comm") as f:
+                if f.read().strip() in helpers:
+                    continue
+        except (ValueError, OSError):
+            continue
+        sid = next((s for s, r in roots.items() if (path + "/").startswith(r)), name if name in roots else None)
+        if sid is not None and sid not in sessions:
+            sessions[sid] = (name, int(pid))
+    return sessions
+
+roots = {sid: path.rstrip("/") + "/" for sid, path in opts.get("procs", {}).items()}
+sessions = tmux_sessions(roots) if opts.get("tmux") else {}
+interval = float(opts.get("interval", 0.25))
+cpu0, net0, procs0, t0 = cpu_times(), net_bytes(), proc_ticks(roots), time.monotonic()
+time.sleep(interval)
+cpu1, net1, procs1, t1 = cpu_times(), net_bytes(), proc_ticks(roots), time.monotonic()
+elapsed = t1 - t0
+
+def usage(name):
+    total = cpu1[name][0] - cpu0[name][0]
+    idle = cpu1[name][1] - cpu0[name][1]
+    return 100.0 * (total - idle) / total if total else 0.0
+
+meminfo = {}
+with open("/proc/meminfo") as f:
+    for line in f:
+        key, value = line.split(":", 1)
+        meminfo[key] = int(value.split()[0]) * 1024
+st = os.statvfs("/")
+with open("/proc/uptime") as f:
+    uptime = float(f.read().split()[0])
+
+procs = {}
+for sid, now in procs1.items():
+    before = procs0.get(sid, {})
+    ticks = sum(t - before[pid][0] for pid, (t, _) in now.items() if pid in before)
+    session, pane_pid = sessions.get(sid, (None, None))
+    procs[sid] = {
+        "pids": len(now),
+        "pid": pane_pid or (min(map(int, now)) if now else None),
+        "session": session,
+        "cpu": 100.0 * ticks / hz / elapsed,
+        "rss": sum(rss for _, rss in now.values()),
+    }
+
+print(json.dumps({
+    "cpu": usage("cpu"),
+    "cores": [usage(name) for name in cpu1 if name != "cpu"],
+    "load": list(os.getloadavg()),
+    "mem": {"total": meminfo["MemTotal"], "used": meminfo["MemTotal"] - meminfo.get("MemAvailable", meminfo["MemFree"])},
+    "disk": {"total": st.f_blocks * st.f_frsize, "used": (st.f_blocks - st.f_bfree) * st.f_frsize},
+    "uptime": uptime,
+    "net": {"rx": (net1[0] - net0[0]) / elapsed, "tx": (net1[1] - net0[1]) / elapsed},
+    "procs": procs,
+}))
+"""
+
+
+@dataclass
+class HostMetrics:
+    """ホストのリソース使用状況のスナップショット"""
+    cpu: float
+    cores: List[float]
+    load: List[float]
+    mem_used: float
+    mem_total: float
+    disk_used: float
+    disk_total: float
+    uptime: float
+    net_rx: float
+    net_tx: float
+    procs: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "HostMetrics":
+        return cls(
+            cpu=data["cpu"], cores=data["cores"], load=data["load"],
+            mem_used=data["mem"]["used"], mem_total=data["mem"]["total"],
+            disk_used=data["disk"]["used"], disk_total=data["disk"]["total"],
+            uptime=data["uptime"], net_rx=data["net"]["rx"], net_tx=data["net"]["tx"],
+            procs=data.get("procs", {}),
+        )
+
+    @property
+    def mem_percent(self) -> float:
+        return self.mem_used * 100 / self.mem_total if self.mem_total else 0.0
+
+    @property
+    def disk_percent(self) -> float:
+        return self.disk_used * 100 / self.disk_total if self.disk_total else 0.0
+
+    def uptime_text(self) -> str:
+        """稼働時間を「1日2時間3分」形式で返す"""
+        minutes = int(self.uptime // 60)
+        days, minutes = divmod(minutes, 60 * 24)
+        hours, minutes = divmod(minutes, 60)
+        return (f"{days}日" if days else "") + (f"{hours}時間" if hours else "") + f"{minutes}分"
+
+
+class MetricsCollector:
+    """/proc を読むエージェントを1回のSSH呼び出しで実行し、メトリクスを取得するクラス"""
+    def __init__(self, remote: RemoteClient, interval: float = 0.25):
+        self.remote = remote
+        self.interval = interval
+
+    async def collect(self, procs: Optional[Dict[str, str]] = None) -> HostMetrics:
+        """メトリクスを取得（procs に {サーバーID: ディレクトリ} を渡すとプロセスごとの使用量と tmux セッションも集計）"""
+        opts = json.dumps({"interval": self.interval, "procs": procs or {}, "tmux": bool(procs), "helpers": constants.helper_processes})
+        output = await self.remote.execute(f"python3 - {shlex.quote(opts)}", input=METRICS_AGENT)
+        try:
+            return HostMetrics.from_dict(json.loads(output))
+        except (ValueError, KeyError) as e:
+            raise ConnectionError(f"メトリクスの解析に失敗しました: {e}")
+
+class RingBuffer:
+    """固定長の時系列リングバッファ（array に詰めて保持し、メモリ使用量を一定に保つ）"""
+    def __init__(self, capacity: int, fields: Tuple[str, ...]):
+        self.capacity = capacity
+        self.fields = fields
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("f", bytes(4 * capacity * len(fields)))
+        self.head = 0
+        self.size = 0
+
+    def append(self, ts: float, values: Dict[str, float]):
+        self.times[self.head] = ts
+        base = self.head * len(self.fields)
+        for i, name in enumerate(self.fields):
+            self.values[base + i] = values[name]
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def _indices(self):
+        start = (self.head - self.size) % self.capacity
+        return ((start + i) % self.capacity for i in range(self.size))
+
+    def series(self, name: str, since: float = 0.0) -> List[Tuple[float, float]]:
+        """指定項目の (時刻, 値) を古い順に返す"""
+        offset = self.fields.index(name)
+        width = len(self.fields)
+        return [(self.times[i], self.values[i * width + offset]) for i in self._indices() if self.times[i] >= since]
+
+
+class MetricsHistory:
+    """メトリクス履歴を解像度の異なる階層（1h/24h/7d）に分けて保持するクラス"""
+    fields = ("cpu", "mem", "disk")
+
+    def __init__(self, periods: Dict[str, Dict[str, Any]], interval: int):
+        self.interval = interval
+        self.tiers: Dict[str, Dict[str, Any]] = {}
+        for key, period in periods.items():
+            step = period["step"] or interval
+            self.tiers[key] = {
+                "step": step,
+                "span": period["span"],
+                "buffer": RingBuffer(period["span"] // step, self.fields),
+                "bucket": None,
+                "sums": [0.0] * len(self.fields),
+                "count": 0,
+            }
+
+    def record(self, ts: float, values: Dict[str, float]):
+        """サンプルを追加し、粗い階層にはバケットごとの平均値を書き込む"""
+        for tier in self.tiers.values():
+            if tier["step"] == self.interval:
+                tier["buffer"].append(ts, values)
+                continue
+            bucket = int(ts // tier["step"])
+            if tier["bucket"] is not None and bucket != tier["bucket"] and tier["count"]:
+                averages = {name: total / tier["count"] for name, total in zip(self.fields, tier["sums"])}
+                tier["buffer"].append(tier["bucket"] * tier["step"], averages)
+                tier["sums"] = [0.0] * len(self.fields)
+                tier["count"] = 0
+            tier["bucket"] = bucket
+            tier["sums"] = [total + values[name] for name, total in zip(self.fields, tier["sums"])]
+            tier["count"] += 1
+
+    def series(self, period: str, name: str) -> List[Tuple[float, float]]:
+        tier = self.tiers[period]
+        return tier["buffer"].series(name, since=time.time() - tier["span"])
+
+
+class HistorySampler:
+    """ホストがオンラインの間、一定間隔でメトリクスを記録するクラス
+
+    同じ SSH 呼び出しでサーバーごとのプロセスも集計し、収集の開始時刻と共に on_sample に渡す（オフライン時は None）。
+    """
+    def __init__(self, collector: MetricsCollector, devices: DeviceManager, history: MetricsHistory,
+                 procs: Optional[Callable[[], Dict[str, str]]] = None, on_sample: Optional[Callable[[Optional[HostMetrics], float], None]] = None):
+        self.collector = collector
+        self.devices = devices
+        self.history = history
+        self.procs = procs
+        self.on_sample = on_sample
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            started = time.monotonic()
+            try:
+                if await self.devices.is_online():
+                    metrics = await self.collector.collect(self.procs() if self.procs else None)
+                    self.history.record(time.time(), {"cpu": metrics.cpu, "mem": metrics.mem_percent, "disk": metrics.disk_percent})
+                else:
+                    metrics = None
+                if self.on_sample:
+                    self.on_sample(metrics, started)
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            except Exception as e:
+                # 想定外の例外でタスクが止まると履歴・状態キャッシュ・負荷判定がすべて更新されなくなる
+                print(f"メトリクスの記録に失敗しました ({self.collector.remote.host}): {e!r}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.history.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def wake(self):
+        """次の記録を待たずにすぐ収集する"""
+        self._wake.set()
+
+    def start(self):
+        """バックグラウンドでの記録を開始"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """バックグラウンドでの記録を停止"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+
+class Host:
+    """1台の物理ホストと、それに紐づくSSH接続・死活監視・メトリクスをまとめたクラス"""
+    def __init__(self, name: str, label: str, ssh_host: str, ssh_port: int, ssh_user: str, mac: str, broadcast_ip: str,
+                 games_root: str, backup_root: str, public_address: Optional[str] = None, wol_port: int = 9):
+        self.name = name
+        self.label = label
+        self.games_root = games_root.rstrip("/")
+        self.backup_root = backup_root.rstrip("/")
+        self.public_address = public_address
+        self.remote = RemoteClient(ssh_host, ssh_port, ssh_user)
+        self.monitor = HostMonitor(ssh_host, ssh_port)
+        self.devices = DeviceManager(ssh_host, mac, broadcast_ip, config.ping_timeout, self.monitor, self.remote, wol_port)
+        self.metrics = MetricsCollector(self.remote)
+        self.history = MetricsHistory(constants.history_periods, config.history_interval)
+        self.sampler = HistorySampler(self.metrics, self.devices, self.history, procs=self.server_dirs,
+                                      on_sample=lambda metrics, sampled_at: status_cache.update(self.name, metrics, sampled_at))
+
+    @classmethod
+    def from_definition(cls, definition: Dict[str, Any]) -> "Host":
+        """定義から生成し、再読み込み時の比較用に定義を保持する"""
+        host = cls(**definition)
+        host.definition = definition
+        return host
+
+    @property
+    def job_target(self) -> str:
+        """スケジューラ上でこのホストの電源操作を表すキー"""
+        return f"host:{self.name}"
+
+    def game_dir(self, server_id: str) -> str:
+        return f"{self.games_root}/{server_id}"
+
+    def game_script(self, server_id: str) -> str:
+        return f"{self.game_dir(server_id)}/gs"
+
+    def backup_dir(self, server_id: str) -> str:
+        return f"{self.backup_root}/{server_id}"
+
+    def server_dirs(self) -> Dict[str, str]:
+        """このホスト上のサーバーID -> ディレクトリ"""
+        return {p["id"]: self.game_dir(p["id"]) for p in profile_registry.for_host(self.name)}
+
+    def start(self):
+        """死活監視とメトリクス記録を開始"""
+        self.monitor.start()
+        self.sampler.start()
+
+    def stop(self):
+        """死活監視とメトリクス記録を止め、SSH 接続を閉じる（再読み込みで置き換えられたとき）"""
+        self.monitor.stop()
+        self.sampler.stop()
+        asyncio.create_task(self.remote.close())
+
+
+hosts: Dict[str, Host] = {}
+
+host_keys = set(inspect.signature(Host.__init__).parameters) - {"self"}
+
+def build_hosts(snapshot: ProfileSnapshot) -> Dict[str, Host]:
+    """servers.json のホスト定義からホストを構築（省略した項目は環境変数の設定を使う）
+
+    定義が変わっていないホストは、接続や監視状態ごと現在のものを引き継ぐ。
+    """
+    defaults = {
+        "ssh_host": config.ssh_host, "ssh_port": config.ssh_port, "ssh_user": config.ssh_user,
+        "mac": config.target_mac, "broadcast_ip": config.broadcast_ip, "wol_port": config.wol_port, "games_root": config.games_root,
+        "backup_root": config.backup_root,
+    }
+    result = {}
+    for definition in snapshot.host_profiles or [profile_registry.default_host]:
+        unknown = set(definition) - host_keys
+        if unknown:
+            raise ValueError(f"ホスト `{definition['name']}` に不明な項目があります: {', '.join(sorted(unknown))}")
+        options = {"label": definition["name"], "public_address": None, **defaults, **definition}
+        current = hosts.get(definition["name"])
+        if current and current.definition == options:
+            result[definition["name"]] = current
+        else:
+            result[definition["name"]] = Host.from_definition(options)
+    return result
+
+def load_hosts(snapshot: ProfileSnapshot) -> Callable[[], None]:
+    """再読み込みされた定義からホストを構築し、差し替える関数を返す"""
+    result = build_hosts(snapshot)
+
+    def commit():
+        for name, host in hosts.items():
+            if result.get(name) is not host:
+                host.stop()
+        for host in result.values():
+            host.start()
+        hosts.clear()
+        hosts.update(result)
+    return commit
+
+hosts.update(build_hosts(profile_registry.snapshot))
+profile_registry.listeners.append(load_hosts)
+
+def get_host(name: Optional[str] = None) -> Host:
+    """名前からホストを取得（省略時は最初に定義されたホスト）"""
+    if not name:
+        return next(iter(hosts.values()))
+    if name not in hosts:
+        raise ValueError(f"ホスト `{name}` が見つかりません。")
+    return hosts[name]
+
+def host_for(profile: Dict[str, Any]) -> Host:
+    """サーバー定義が属するホストを取得"""
+    return get_host(profile.get("host"))
+
+
+@dataclass
+class ServerStatus:
+    """ゲームサーバーのプロセスの状態"""
+    running: bool
+    pids: int = 0
+    pid: Optional[int] = None
+    session: Optional[str] = None
+    cpu: float = 0.0
+    rss: int = 0
+    updated: float = field(default_factory=time.monotonic)
+
+
+class StatusCache:
+    """ホストごとのメトリクス収集の結果から、各サーバーの稼働状態を保持するクラス
+
+    起動/停止のコマンドを実行したサーバーは即座に無効化し、そのホストの再収集を要求する。
+    """
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.entries: Dict[str, ServerStatus] = {}
+        self._invalidated: Dict[str, float] = {}
+
+    def update(self, host_name: str, metrics: Optional[HostMetrics], sampled_at: float):
+        """収集結果を反映する（metrics が None ならホストはオフライン）
+
+        収集の開始後に無効化されたサーバーは、コマンド実行前の状態の可能性があるため反映しない。
+        """
+        for profile in profile_registry.for_host(host_name):
+            if self._invalidated.get(profile["id"], 0.0) > sampled_at:
+                continue
+            if metrics is None:
+                self.entries[profile["id"]] = ServerStatus(running=False, updated=sampled_at)
+            elif (proc := metrics.procs.get(profile["id"])) is not None:
+                self.entries[profile["id"]] = ServerStatus(
+                    running=bool(proc["pids"] or proc.get("session")), pids=proc["pids"], pid=proc.get("pid"), session=proc.get("session"),
+                    cpu=proc["cpu"], rss=int(proc["rss"]), updated=sampled_at,
+                )
+
+    def get(self, server_id: str) -> Optional[ServerStatus]:
+        """新しい状態があれば返す（無い・古い場合は None）"""
+        status = self.entries.get(server_id)
+        if status is None or time.monotonic() - status.updated > self.max_age:
+            return None
+        return status
+
+    def invalidate(self, profile: Dict[str, Any]):
+        """サーバーの状態を破棄し、ホストの再収集を要求する"""
+        self.entries.pop(profile["id"], None)
+        self._invalidated[profile["id"]] = time.monotonic()
+        host_for(profile).sampler.wake()
+
+status_cache = StatusCache(config.history_interval * 3)
+
+
+@dataclass
+class QueryResult:
+    """ゲームサーバーへの問い合わせ結果"""
+    online: bool
+    players: Optional[int] = None
+    max_players: Optional[int] = None
+    names: List[str] = field(default_factory=list)
+    version: Optional[str] = None
+    latency: float = 0.0
+    error: Optional[str] = None
+    misconfigured: bool = False  # 認証失敗や応答形式の不一致など、サーバーの停止ではなく設定の誤りを示す失敗
+
+
+class GameQuery:
+    """Minecraft SLP / Source A2S_INFO / Source RCON でプレイヤー数を問い合わせるクラス
+
+    SSH を使わずにゲームサーバーへ直接問い合わせ、結果は短時間キャッシュする。
+    """
+    def __init__(self, ttl: float = 5.0, timeout: float = 2.0):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._cache: Dict[str, Tuple[float, QueryResult]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def _varint(value: int) -> bytes:
+        value &= 0xFFFFFFFF
+        out = bytearray()
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                out.append(byte | 0x80)
+            else:
+                out.append(byte)
+                return bytes(out)
+
+    @staticmethod
+    async def _read_varint(reader: asyncio.StreamReader) -> int:
+        value = 0
+        for shift in range(0, 35, 7):
+            byte = (await reader.readexactly(1))[0]
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+        raise ValueError("VarInt が長すぎます")
+
+    @staticmethod
+    async def query_minecraft(host: str, port: int, timeout: float) -> QueryResult:
+        """Minecraft Server List Ping (1.7 以降) で問い合わせ"""
+        varint = GameQuery._varint
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        try:
+            encoded_host = host.encode("utf-8")
+            handshake = varint(0) + varint(-1) + varint(len(encoded_host)) + encoded_host + struct.pack(">H", port) + varint(1)
+            writer.write(varint(len(handshake)) + handshake + varint(1) + varint(0))
+            await writer.drain()
+
+            async def _read() -> Dict[str, Any]:
+                await GameQuery._read_varint(reader)  # パケット長
+                await GameQuery._read_varint(reader)  # パケットID
+                length = await GameQuery._read_varint(reader)
+                return json.loads(await reader.readexactly(length))
+
+            status = await asyncio.wait_for(_read(), timeout)
+        finally:
+            writer.close()
+        players = status.get("players", {})
+        return QueryResult(
+            online=True, players=players.get("online"), max_players=players.get("max"),
+            names=[p.get("name", "") for p in players.get("sample", [])], version=status.get("version", {}).get("name"),
+        )
+
+    @staticmethod
+    async def query_a2s(host: str, port: int, timeout: float) -> QueryResult:
+        """Source A2S_INFO (UDP) で問い合わせ（チャレンジ応答にも対応）"""
+        loop = asyncio.get_running_loop()
+        responses: asyncio.Queue = asyncio.Queue()
+
+        class _Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                responses.put_nowait(data)
+
+            def error_received(self, exc):
+                responses.put_nowait(exc)
+
+        transport, _ = await loop.create_datagram_endpoint(_Protocol, remote_addr=(host, port))
+        try:
+            request = b"\xFF\xFF\xFF\xFFTSource Engine Query\x00"
+            transport.sendto(request)
+            data = await asyncio.wait_for(responses.get(), timeout)
+            if isinstance(data, Exception):
+                raise data
+            if data[4:5] == b"A":
+                transport.sendto(request + data[5:9])
+                data = await asyncio.wait_for(responses.get(), timeout)
+                if isinstance(data, Exception):
+                    raise data
+        finally:
+            transport.close()
+        if data[4:5] != b"I":
+            raise ValueError("A2S_INFO の応答が不正です")
+
+        offset = 6
+        strings = []
+        for _ in range(4):  # name, map, folder, game
+            end = data.index(b"\x00", offset)
+            strings.append(data[offset:end].decode("utf-8", errors="replace"))
+            offset = end + 1
+        app_id = struct.unpack_from("<H", data, offset)[0]
+        players, max_players = data[offset + 2], data[offset + 3]
+        # bots, type, environment, visibility, VAC の後にバージョンが続く（The Ship は3バイト多い）
+        offset += 9 + (3 if app_id == 2400 else 0)
+        version = data[offset:data.index(b"\x00", offset)].decode("utf-8", errors="replace")
+        return QueryResult(online=True, players=players, max_players=max_players, version=version)
+
+    @staticmethod
+    async def query_rcon(host: str, port: int, password: str, command: str, timeout: float) -> QueryResult:
+        """Source RCON で認証してコマンドを実行し、応答からプレイヤー数を読み取る"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+        async def _packet(request_id: int, kind: int, body: str) -> Tuple[int, str]:
+            payload = struct.pack("<ii", request_id, kind) + body.encode("utf-8") + b"\x00\x00"
+            writer.write(struct.pack("<i", len(payload)) + payload)
+            await writer.drain()
+            while True:
+                size = struct.unpack("<i", await reader.readexactly(4))[0]
+                response_id, response_kind = struct.unpack("<ii", await reader.readexactly(8))
+                text = (await reader.readexactly(size - 8))[:-2].decode("utf-8", errors="replace")
+                # 認証時は空の RESPONSE_VALUE が先に届くことがあるため読み飛ばす
+                if kind == 3 and response_kind != 2:
+                    continue
+                return response_id, text
+
+        try:
+            response_id, _ = await asyncio.wait_for(_packet(1, 3, password), timeout)
+            if response_id == -1:
+                raise PermissionError("RCON の認証に失敗しました")
+            _, text = await asyncio.wait_for(_packet(2, 2, command), timeout)
+        finally:
+            writer.close()
+
+        lines = [line for line in text.strip().splitlines() if line]
+        if lines and lines[0].lower().startswith("name,"):
+            # Palworld の ShowPlayers は CSV（1行目はヘッダ）
+            names = [line.split(",")[0] for line in lines[1:]]
+            return QueryResult(online=True, players=len(names), names=names)
+        match = re.search(r"(\d+)\s*(?:/|of a max of)\s*(\d+)", text)
+        if match:
+            return QueryResult(online=True, players=int(match.group(1)), max_players=int(match.group(2)))
+        return QueryResult(online=True)
+
+    def address(self, profile: Dict[str, Any]) -> Tuple[str, int]:
+        """問い合わせ先のアドレスを決める（info の hostname/port を優先）"""
+        info = profile.get("info", {})
+        query = info["query"]
+        host = query.get("host") or info.get("hostname") or host_for(profile).devices.host
+        port = query.get("port") or info.get("port") or constants.query_ports[query["type"]]
+        return host, port
+
+    async def _query(self, profile: Dict[str, Any]) -> QueryResult:
+        query = profile["info"]["query"]
+        host, port = self.address(profile)
+        started = time.monotonic()
+        try:
+            if query["type"] == "minecraft":
+                result = await self.query_minecraft(host, port, self.timeout)
+            elif query["type"] == "a2s":
+                result = await self.query_a2s(host, port, self.timeout)
+            elif query["type"] == "rcon":
+                result = await self.query_rcon(host, port, query.get("password", ""), query.get("command", "ShowPlayers"), self.timeout)
+            else:
+                raise ValueError(f"未対応の問い合わせ方式です: {query['type']}")
+        except (PermissionError, ValueError, struct.error, IndexError) as e:
+            result = QueryResult(online=False, error=str(e) or type(e).__name__, misconfigured=True)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            result = QueryResult(online=False, error=str(e) or type(e).__name__)
+        result.latency = time.monotonic() - started
+        self._cache[profile["id"]] = (time.monotonic(), result)
+        return result
+
+    async def query(self, profile: Dict[str, Any]) -> Optional[QueryResult]:
+        """サーバーに問い合わせる（問い合わせ設定が無ければ None、キャッシュが新しければそれを返す）"""
+        if "query" not in profile.get("info", {}):
+            return None
+        server_id = profile["id"]
+        cached = self._cache.get(server_id)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        task = self._inflight.get(server_id)
+        if task is None:
+            task = asyncio.create_task(self._query(profile))
+            self._inflight[server_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(server_id, None))
+        return await asyncio.shield(task)
+
+    async def query_all(self, profiles: List[Dict[str, Any]]) -> Dict[str, Optional[QueryResult]]:
+        """全サーバーに並行して問い合わせる"""
+        results = await asyncio.gather(*[self.query(p) for p in profiles])
+        return {p["id"]: r for p, r in zip(profiles, results)}
+
+game_query = GameQuery()
+
+@dataclass
+class Job:
+    """スケジューラに投入された処理"""
+    target: str
+    action: str
+    label: str
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    waiters: int = 1
+    task: Optional[asyncio.Task] = None
+
+
+class JobScheduler:
+    """対象ごとに処理を直列化し、待機列の末尾にある同じ処理には相乗りさせるスケジューラ"""
+    def __init__(self, concurrency: int):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._queues: Dict[str, List[Job]] = {}
+
+    async def run(self, target: str, action: str, label: str, factory: Callable[[], Awaitable[Any]], limited: bool = True, share: bool = True) -> Any:
+        """処理を投入して結果を待つ
+
+        同じ対象の最後の処理が同じ内容ならその結果を共有する。後ろに別の処理が控えている場合は
+        結果が上書きされるため相乗りせず、列の末尾に新しく並ぶ。
+        limited=False の処理（ホストの電源操作など）は同時実行数の上限を受けない。
+        share=False の処理（呼び出し元ごとに進捗を表示するものなど）は相乗りせず、常に新しく並ぶ。
+        """
+        queue = self._queues.setdefault(target, [])
+        job = queue[-1] if queue else None
+        if share and job and job.action == action:
+            job.waiters += 1
+        else:
+            job = Job(target, action, label)
+            queue.append(job)
+            job.task = asyncio.create_task(self._execute(job, factory, limited))
+        return await asyncio.shield(job.task)
+
+    async def _start(self, job: Job, factory: Callable[[], Awaitable[Any]]) -> Any:
+        job.started_at = time.time()
+        if perf.enabled:
+            perf.observe("job.queue", job.started_at - job.created_at)
+        return await factory()
+
+    async def _execute(self, job: Job, factory: Callable[[], Awaitable[Any]], limited: bool) -> Any:
+        lock = self._locks.setdefault(job.target, asyncio.Lock())
+        try:
+            async with lock:
+                if limited:
+                    async with self._semaphore:
+                        return await self._start(job, factory)
+                return await self._start(job, factory)
+        finally:
+            queue = self._queues[job.target]
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.target]
+
+    def jobs(self) -> List[Job]:
+        """待機中・実行中の処理を投入順に返す"""
+        return sorted((j for queue in self._queues.values() for j in queue), key=lambda j: j.created_at)
+
+job_scheduler = JobScheduler(config.job_concurrency)
+
+
+class StateStore:
+    """実行中の処理やプレゼンスなどを SQLite (WAL) に保存するクラス
+
+    書き込みはキューに積むだけで即座に戻り、バックグラウンドでまとめて1トランザクションで反映する。
+    """
+    def __init__(self, path: str, flush_interval: float = 0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn: Optional[sqlite3.Connection] = None
+        self._queue: List[Tuple[str, Tuple[Any, ...]]] = []
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _open(self) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """データベースを開き、保存済みの処理と値を読み込む（ブロッキング処理）"""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS operations (id TEXT PRIMARY KEY, kind TEXT, target TEXT, channel_id INTEGER, message_id INTEGER, started_at REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        columns = ("id", "kind", "target", "channel_id", "message_id", "started_at")
+        operations = [dict(zip(columns, row)) for row in self._conn.execute(f"SELECT {', '.join(columns)} FROM operations ORDER BY started_at")]
+        values = {key: json.loads(value) for key, value in self._conn.execute("SELECT key, value FROM kv")}
+        return operations, values
+
+    def _apply(self, batch: List[Tuple[str, Tuple[Any, ...]]]):
+        with self._conn:
+            for sql, params in batch:
+                self._conn.execute(sql, params)
+
+    async def open(self) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """データベースを開いて書き込みを開始し、前回終了時に残っていた処理と値を返す"""
+        loaded = await asyncio.to_thread(self._open)
+        self._task = asyncio.create_task(self._run())
+        return loaded
+
+    def _enqueue(self, sql: str, params: Tuple[Any, ...]):
+        self._queue.append((sql, params))
+        self._wake.set()
+
+    async def flush(self):
+        async with self._lock:
+            if self._queue and self._conn:
+                batch, self._queue = self._queue, []
+                await asyncio.to_thread(self._apply, batch)
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._wake.clear()
+            try:
+                # 終了時にキャンセルされても、書き込み中のまとまりは最後まで反映する
+                await asyncio.shield(self.flush())
+            except sqlite3.Error as e:
+                print(f"状態の保存に失敗しました: {e}")
+
+    async def close(self):
+        """未反映の書き込みをすべて反映してデータベースを閉じる"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def set(self, key: str, value: Any):
+        """値を保存する"""
+        self._enqueue("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def begin(self, kind: str, target: str, message: discord.Message) -> str:
+        """実行中の処理と、その進捗を表示しているメッセージを記録する"""
+        op_id = uuid.uuid4().hex
+        self._enqueue("INSERT INTO operations (id, kind, target, channel_id, message_id, started_at) VALUES (?, ?, ?, ?, ?, ?)",
+                      (op_id, kind, target, message.channel.id, message.id, time.time()))
+        return op_id
+
+    def finish(self, op_id: str):
+        self._enqueue("DELETE FROM operations WHERE id = ?", (op_id,))
+
+    @contextmanager
+    def track(self, kind: str, target: str, message: discord.Message) -> Iterator[str]:
+        """with ブロックの間、処理を実行中として記録する"""
+        op_id = self.begin(kind, target, message)
+        try:
+            yield op_id
+        finally:
+            self.finish(op_id)
+
+state_store = StateStore(config.state_db)
+
+_close_client = client.close
+
+async def close_client():
+    """Discord から切断し、キューに残っている状態を保存してから終了する"""
+    await _close_client()
+    await state_store.close()
+
+client.close = close_client
+
+# 再起動を待っているホストの、再起動前の boot_id（ボットが再起動しても完了を確認できるよう保存する）
+reboot_boot_ids: Dict[str, str] = {}
+
+# ボットが起動/停止したサーバーの状態（サーバーID -> 起動中か）
+server_states: Dict[str, bool] = {}
+
+def set_server_state(server_id: str, running: bool):
+    server_states[server_id] = running
+    state_store.set("server_states", server_states)
+    presence.refresh()
+
+
+class PresenceUpdater:
+    """起動中のサーバーすべてをプレゼンスに反映するクラス
+
+    短時間に続いた変更はまとめ、表示が変わる場合だけ change_presence を呼ぶ。
+    """
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.current: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def text(self) -> Optional[str]:
+        names = [p["name"] for server_id, running in server_states.items() if running and (p := profile_registry.get(server_id))]
+        if not names:
+            return None
+        text = " / ".join(names)
+        return text if len(text) <= 128 else f"{len(names)}個のサーバー"
+
+    def refresh(self):
+        """プレゼンスの更新を予約する"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._apply())
+
+    async def _apply(self, force: bool = False):
+        if not force:
+            await asyncio.sleep(self.delay)
+        if not client.is_ready():
+            # 接続前は on_ready でまとめて反映する
+            return
+        text = self.text()
+        if force or text != self.current:
+            self.current = text
+            await client.change_presence(activity=discord.Game(name=text) if text else None)
+
+    async def apply_now(self):
+        await self._apply(force=True)
+
+presence = PresenceUpdater(constants.presence_delay)
+
+
+async def power_on_host(host: Host) -> bool:
+    """ホストがオフラインならWoLで起動し、オンラインになるまで待機"""
+    if await host.devices.is_online():
+        return True
+    started = time.monotonic()
+    host.devices.send_wol()
+    if not await host.devices.wait_for_online():
+        return False
+    # 次回以降の確認間隔の見積もりに使う
+    host.devices.learn_boot_time(time.monotonic() - started)
+    state_store.set("boot_times", {h.name: h.devices.boot_time for h in hosts.values() if h.devices.boot_time})
+    return True
+
+async def send_power_command(host: Host, command: str):
+    """シャットダウン・再起動のコマンドを送る（完了前に接続が切れるのは正常なため、切断は無視して状態の変化で確認する）"""
+    try:
+        await host.remote.execute(command)
+    except ConnectionResetError:
+        pass
+
+async def power_off_host(host: Host) -> bool:
+    """ホストをシャットダウンし、オフラインになるまで待機"""
+    if not await host.devices.is_online():
+        return True
+    await send_power_command(host, "sudo poweroff")
+    if not await host.devices.wait_for_offline():
+        return False
+    for profile in profile_registry.for_host(host.name):
+        set_server_state(profile["id"], False)
+    status_cache.update(host.name, None, time.monotonic())
+    return True
+
+async def reboot_host(host: Host) -> bool:
+    """ホストを再起動し、boot_id が変わってオンラインに戻るまで待機"""
+    reboot_boot_ids[host.name] = await host.devices.boot_id()
+    state_store.set("reboot_boot_ids", reboot_boot_ids)
+    await state_store.flush()
+    try:
+        await send_power_command(host, "sudo reboot")
+    except Exception:
+        reboot_boot_ids.pop(host.name, None)
+        state_store.set("reboot_boot_ids", reboot_boot_ids)
+        raise
+    return await wait_for_host_reboot(host)
+
+async def wait_for_host_reboot(host: Host) -> bool:
+    """保存した boot_id から再起動の完了を待つ"""
+    completed = await host.devices.wait_for_reboot(reboot_boot_ids[host.name], config.ping_timeout * 2)
+    reboot_boot_ids.pop(host.name, None)
+    state_store.set("reboot_boot_ids", reboot_boot_ids)
+    return completed
+
+async def run_server_action(profile: Dict[str, Any], action: str) -> bool:
+    """ゲームサーバーに start/stop を実行（起動時はスクリプトが利用可能になるまで待機）"""
+    host = host_for(profile)
+    game_script_path = host.game_script(profile["id"])
+    if action == "start":
+        # LinuxGSM 以外のサーバーにはスクリプトが無いため SSH の疎通のみ確認する
+        path_to_check = game_script_path if profile.get("gsm") else None
+        if not await host.devices.wait_for_ssh_ready(config.ssh_ready_timeout, path_to_check):
+            return False
+    command = f"{game_script_path} {action}" if profile.get("gsm") else profile["command"][action]
+    try:
+        with perf.timer(f"server.{action}"):
+            await host.remote.execute(command)
+    finally:
+        status_cache.invalidate(profile)
+    set_server_state(profile["id"], action == "start")
+    return True
+
+
+def build_backup_command(source: str, dest: str, keep: int, bwlimit: int, excludes: List[str]) -> str:
+    """サーバーのディレクトリを圧縮して保存するシェルスクリプトを組み立てる
+
+    実行中のサーバーでも取れるよう読み込み中の変更は警告として扱い、nice/ionice と pv の帯域制限で負荷を抑える。
+    pv があれば進捗を百分率で1行ずつ出力し、最後に「RESULT 状態 サイズ パス」を出力する。
+    アーカイブが前回と同じ（チェックサムが一致する）場合は保存せず、古いアーカイブは keep 個を残して削除する。
+    tar はファイルの更新時刻も記録するため、一致するのはディレクトリ内が一切書き換えられていない場合（停止中など）に限られる。
+    """
+    q = shlex.quote
+    exclude_args = " ".join(f"--exclude={q('./' + e)}" for e in excludes)
+    limit = f"-L {bwlimit}m" if bwlimit else ""
+    script = f"""
+src={q(source)}; dest={q(dest)}
+cd "$src" && mkdir -p "$dest" || exit 1
+name="$(date +%Y%m%d-%H%M%S).tar.gz"; part="$dest/.$name.part"
+size=$(du -sb {exclude_args} . 2>/dev/null | cut -f1)
+lowprio="nice -n 19"; command -v ionice >/dev/null && lowprio="$lowprio ionice -c 3"
+throttle() {{ if command -v pv >/dev/null; then pv -n -i 2 {limit} -s "${{size:-0}}" 2>&3; else cat; fi; }}
+{{ $lowprio tar --sort=name {exclude_args} --warning=no-file-changed --ignore-failed-read -cf - . | throttle | $lowprio gzip -n -1 > "$part"; st=("${{PIPESTATUS[@]}}"); }} 3>&1
+if [ "${{st[0]}}" -gt 1 ] || [ "${{st[2]}}" -ne 0 ]; then rm -f "$part"; echo "RESULT failed 0 -"; exit 1; fi
+sum=$(sha256sum "$part" | cut -d' ' -f1)
+latest=$(ls -1t "$dest"/*.tar.gz 2>/dev/null | head -n 1)
+if [ -n "$latest" ] && [ "$(cat "$latest.sha256" 2>/dev/null)" = "$sum" ]; then
+  rm -f "$part"; touch "$latest" "$latest.sha256"; echo "RESULT duplicate $(stat -c %s "$latest") $latest"
+else
+  mv "$part" "$dest/$name" && echo "$sum" > "$dest/$name.sha256" && echo "RESULT created $(stat -c %s "$dest/$name") $dest/$name"
+fi
+ls -1t "$dest"/*.tar.gz | tail -n +{keep + 1} | while read -r old; do rm -f "$old" "$old.sha256"; done
+"""
+    return f"bash -c {q(script)}"
+
+
+@dataclass
+class BackupResult:
+    """1台のサーバーのバックアップ結果"""
+    status: str  # created / duplicate / failed
+    size: int = 0
+    path: str = ""
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+class BackupManager:
+    """ゲームサーバーのバックアップを並行数を制限して実行するクラス
+
+    サーバーは止めずに低優先度で圧縮し、必要ならメトリクス履歴からホストの負荷が下がるのを待ってから始める。
+    """
+    def __init__(self, concurrency: int, keep: int, bwlimit: int, cpu_threshold: float):
+        # 0 以下だと作成したばかりのアーカイブまで削除してしまう
+        self.keep = max(keep, 1)
+        self.bwlimit = bwlimit
+        self.cpu_threshold = cpu_threshold
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.active: Dict[str, int] = {}
+
+    def recent_cpu(self, host: Host) -> Optional[float]:
+        """直近の CPU 使用率の平均（記録が無ければ None）"""
+        since = time.time() - constants.backup_load_window
+        recent = [v for ts, v in host.history.series("1h", "cpu") if ts >= since]
+        return sum(recent) / len(recent) if recent else None
+
+    async def wait_for_low_load(self, host: Host, on_wait: Callable[[float], None]) -> bool:
+        """CPU 使用率がしきい値を下回るまで待つ（最大待機時間を過ぎたら False）"""
+        deadline = time.monotonic() + constants.backup_max_wait
+        while time.monotonic() < deadline:
+            cpu = self.recent_cpu(host)
+            if cpu is None or cpu < self.cpu_threshold:
+                return True
+            on_wait(cpu)
+            await asyncio.sleep(constants.backup_check_interval)
         return False
 
-device_manager = DeviceManager(config.ssh_host, config.target_mac, config.broadcast_ip, config.ping_timeout)
+    def is_running(self, host: Host) -> bool:
+        return self.active.get(host.name, 0) > 0
+
+    async def run(self, profile: Dict[str, Any], on_progress: Callable[[Optional[float]], None]) -> BackupResult:
+        """バックアップを作成する（on_progress には開始時に None、以降は進捗の百分率を渡す）"""
+        host = host_for(profile)
+        async with self._semaphore:
+            self.active[host.name] = self.active.get(host.name, 0) + 1
+            on_progress(None)
+            started = time.monotonic()
+            result = BackupResult("failed")
+            tail: deque = deque(maxlen=5)
+            command = build_backup_command(host.game_dir(profile["id"]), host.backup_dir(profile["id"]), self.keep, self.bwlimit, constants.backup_excludes)
+            try:
+                with perf.timer("backup.run"):
+                    async for line in host.remote.stream(command):
+                        line = line.strip()
+                        if line.isdigit():
+                            on_progress(float(line))
+                        elif line.startswith("RESULT "):
+                            _, status, size, path = line.split(" ", 3)
+                            result = BackupResult(status, int(size), path)
+                        elif line:
+                            tail.append(line)
+            except ConnectionError as e:
+                result.error = "\n".join(tail) or str(e)
+            finally:
+                self.active[host.name] -= 1
+            result.duration = time.monotonic() - started
+            return result
+
+backup_manager = BackupManager(config.backup_concurrency, config.backup_keep, config.backup_bwlimit, config.backup_cpu_threshold)
+
+
+class IdleCancelView(discord.ui.View):
+    """自動停止の猶予期間中に表示するキャンセルボタン"""
+    def __init__(self, timeout: float):
+        super().__init__(timeout=timeout)
+        self.cancelled = asyncio.Event()
+        self.cancelled_by: Optional[str] = None
+
+    @discord.ui.button(label="キャンセル", style=discord.ButtonStyle.secondary, emoji="✋")
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.cancelled_by = interaction.user.display_name
+        self.cancelled.set()
+        self.stop()
+        await interaction.response.edit_message(embed=EmbedHelper.info("自動停止をキャンセルしました", f"{self.cancelled_by} さんがキャンセルしました。"), view=None)
+
+
+class IdlePolicy:
+    """誰も遊んでいないサーバーを自動停止し、サーバーが無くなったホストの電源を切るポリシーエンジン
+
+    人数はキャッシュ付きの GameQuery、負荷は記録済みのメトリクス履歴から判断するため、
+    定期チェックで SSH セッションを開くことはない。
+    """
+    def __init__(self, channel_id: int, idle_timeout: int, grace: int, interval: int, cpu_threshold: float):
+        self.channel_id = channel_id
+        self.idle_timeout = idle_timeout
+        self.grace = grace
+        self.interval = interval
+        self.cpu_threshold = cpu_threshold
+        self.idle_since: Dict[str, float] = {}
+        self.audit: deque = deque(maxlen=50)
+        self._query_errors: Dict[str, str] = {}
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.channel_id and self.idle_timeout)
+
+    def _log(self, text: str):
+        self.audit.append((time.time(), text))
+
+    def _busy(self, host: Host) -> bool:
+        """直近に記録された CPU 使用率がしきい値以上か（アップデートやバックアップ中の停止を避ける）"""
+        recent = host.history.series("1h", "cpu")
+        return bool(recent) and time.time() - recent[-1][0] < self.interval * 2 and recent[-1][1] >= self.cpu_threshold
+
+    async def _is_idle(self, profile: Dict[str, Any]) -> bool:
+        result = await game_query.query(profile)
+        if result is None or self._busy(host_for(profile)):
+            return False
+        if result.misconfigured:
+            # 人数が分からないだけでプレイヤーがいる可能性があるため、停止せずに記録だけ残す
+            if self._query_errors.get(profile["id"]) != result.error:
+                self._query_errors[profile["id"]] = result.error
+                self._log(f"{profile['name']}: 人数を確認できません ({result.error})")
+            return False
+        self._query_errors.pop(profile["id"], None)
+        if result.online:
+            return result.players == 0
+        # 応答しないサーバーは、プロセスも見当たらない（クラッシュした）場合だけ無人とみなす。
+        # 起動途中や問い合わせポートの誤りで応答しないだけの場合は停止しない。待機時間の間これが続けば停止する。
+        # 独自コマンドのサーバーはディレクトリ外で動くことがあり、プロセスが見つからなくても停止の根拠にならない
+        status = status_cache.get(profile["id"])
+        return bool(profile.get("gsm")) and status is not None and not status.running
+
+    async def _confirm(self, title: str, description: str) -> Tuple[bool, Optional[discord.Message]]:
+        """猶予期間付きの予告を投稿し、キャンセルされなければ True を返す"""
+        channel = client.get_channel(self.channel_id) or await client.fetch_channel(self.channel_id)
+        view = IdleCancelView(timeout=self.grace)
+        message = await channel.send(embed=EmbedHelper.warning(title, f"{description}\n{self.grace}秒以内にキャンセルしなければ実行します。"), view=view)
+        try:
+            await asyncio.wait_for(view.cancelled.wait(), timeout=self.grace)
+        except asyncio.TimeoutError:
+            view.stop()
+            return True, message
+        self._log(f"{title} を {view.cancelled_by} さんがキャンセル")
+        return False, None
+
+    async def _stop_server(self, profile: Dict[str, Any]):
+        server_id = profile["id"]
+        host = host_for(profile)
+        try:
+            minutes = self.idle_timeout // 60
+            confirmed, message = await self._confirm(f"{profile['name']}を自動停止します", f"{profile['name']}は{minutes}分間誰も遊んでいません。")
+            if not confirmed or not await self._is_idle(profile):
+                if confirmed:
+                    await message_editor.edit(message, embed=EmbedHelper.info("自動停止を中止しました", f"{profile['name']}に接続があったため停止しません。"), view=None, final=True)
+                    self._log(f"{profile['name']}: 接続があったため自動停止を中止")
+                self.idle_since[server_id] = time.monotonic()
+                return
+
+            await job_scheduler.run(server_id, "stop", f"{profile['name']}を自動停止", lambda: run_server_action(profile, "stop"))
+            self.idle_since.pop(server_id, None)
+            self._log(f"{profile['name']}: 自動停止")
+            await message_editor.edit(message, embed=EmbedHelper.success("自動停止しました", f"{profile['name']}を停止しました。"), view=None, final=True)
+
+            if not self._host_in_use(host):
+                await self._power_off(host)
+        except Exception as e:
+            self._log(f"{profile['name']}: 自動停止に失敗 ({e})")
+        finally:
+            self._pending.pop(server_id, None)
+
+    def _host_in_use(self, host: Host) -> bool:
+        """ホスト上でゲームサーバーが動いている、または起動・停止などの処理が控えているか
+
+        ボットが起動したサーバーに加え、/gsm やボットの外で起動されて LinuxGSM の tmux セッションが見つかったものも含める。
+        """
+        profiles = profile_registry.for_host(host.name)
+        if any(server_states.get(p["id"]) for p in profiles):
+            return True
+        for profile in profiles:
+            status = status_cache.get(profile["id"])
+            if profile.get("gsm") and status is not None and status.session:
+                return True
+        targets = {p["id"] for p in profiles} | {f"backup:{p['id']}" for p in profiles}
+        return any(job.target in targets for job in job_scheduler.jobs())
+
+    async def _power_off(self, host: Host):
+        if backup_manager.is_running(host):
+            self._log(f"{host.label}: バックアップ中のため自動シャットダウンを見送り")
+            return
+        confirmed, message = await self._confirm(f"{host.label}をシャットダウンします", "起動中のゲームサーバーがなくなりました。")
+        if not confirmed:
+            return
+        if self._host_in_use(host):
+            await message_editor.edit(message, embed=EmbedHelper.info("シャットダウンを中止しました", "猶予期間中にサーバーが起動されました。"), view=None, final=True)
+            return
+        if await job_scheduler.run(host.job_target, "off", f"{host.label}をシャットダウン", lambda: power_off_host(host), limited=False):
+            self._log(f"{host.label}: 自動シャットダウン")
+            await message_editor.edit(message, embed=EmbedHelper.success("シャットダウン成功", f"*`{host.label}`*がオフラインになりました。"), view=None, final=True)
+        else:
+            self._log(f"{host.label}: 自動シャットダウンがタイムアウト")
+            await message_editor.edit(message, embed=EmbedHelper.warning("シャットダウンタイムアウト", f"{config.ping_timeout}秒以内に*`{host.label}`*がオフラインになりませんでした。"), view=None, final=True)
+
+    async def tick(self):
+        """起動中のサーバーを確認し、待機時間を超えて無人のものを停止予告する"""
+        now = time.monotonic()
+        for profile in [p for p in profile_registry.profiles() if server_states.get(p["id"])]:
+            server_id = profile["id"]
+            if not await host_for(profile).devices.is_online() or not await self._is_idle(profile):
+                self.idle_since.pop(server_id, None)
+                continue
+            since = self.idle_since.setdefault(server_id, now)
+            if now - since >= self.idle_timeout and server_id not in self._pending:
+                self._pending[server_id] = asyncio.create_task(self._stop_server(profile))
+
+    async def _run(self):
+        await client.wait_until_ready()
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                self._log(f"チェックに失敗 ({e})")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """有効化されていればバックグラウンドでの監視を開始"""
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+idle_policy = IdlePolicy(config.idle_channel_id, config.idle_timeout, config.idle_grace, config.idle_check_interval, config.idle_cpu_threshold)
+
+# ==============================================================================
+# 起動処理
+# ==============================================================================
+
+# 起動の各段階までの経過時間（秒）
+startup_timings: Dict[str, float] = {}
+
+def read_cache(name: str) -> Optional[Dict[str, Any]]:
+    """キャッシュディレクトリから JSON を読み込む（無い・壊れている場合は None）"""
+    try:
+        return load_json(os.path.join(config.cache_dir, name))
+    except (OSError, ValueError):
+        return None
+
+def write_cache(name: str, data: Dict[str, Any]):
+    """キャッシュディレクトリに JSON を書き込む（一時ファイル経由で置き換える）"""
+    os.makedirs(config.cache_dir, exist_ok=True)
+    path = os.path.join(config.cache_dir, name)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+_global_ip: Optional[Tuple[str, float]] = None
+_global_ip_lock = asyncio.Lock()
+
+async def get_global_ip() -> str:
+    """公開IPアドレスを取得（タイムアウト付きで非同期に問い合わせ、結果はディスクにもキャッシュ）"""
+    global _global_ip
+    if config.public_hostname:
+        return config.public_hostname
+    async with _global_ip_lock:
+        if _global_ip and time.time() - _global_ip[1] < config.global_ip_ttl:
+            return _global_ip[0]
+        cached = await asyncio.to_thread(read_cache, "global_ip.json")
+        if cached and time.time() - cached["fetched_at"] < config.global_ip_ttl:
+            _global_ip = (cached["ip"], cached["fetched_at"])
+            return cached["ip"]
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+                async with session.get("https://api.ipify.org") as response:
+                    response.raise_for_status()
+                    ip = (await response.text()).strip()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # 取得できなければ期限切れのキャッシュでも使う
+            return cached["ip"] if cached else "取得失敗"
+        _global_ip = (ip, time.time())
+        await asyncio.to_thread(write_cache, "global_ip.json", {"ip": ip, "fetched_at": _global_ip[1]})
+        return ip
+
+async def sync_commands() -> bool:
+    """コマンド定義のハッシュが前回の同期時と異なる場合のみ同期する"""
+    payload = json.dumps([c.to_dict(tree) for c in tree.get_commands()], sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha256(f"{client.application_id}:{payload}".encode("utf-8")).hexdigest()
+    cached = await asyncio.to_thread(read_cache, "command_tree.json")
+    if cached and cached.get("hash") == digest:
+        return False
+    await tree.sync()
+    await asyncio.to_thread(write_cache, "command_tree.json", {"hash": digest})
+    return True
 
 # ==============================================================================
 # Discord イベントハンドラ & コマンド
 # ==============================================================================
 
+# 前回終了時に実行中だった処理（setup_hook で読み込み、on_ready で再開）
+pending_operations: List[Dict[str, Any]] = []
+
+async def resume_operation(operation: Dict[str, Any]):
+    """再起動で中断された処理を再開・照合し、止まったままの進捗メッセージを更新する"""
+    try:
+        channel = client.get_channel(operation["channel_id"]) or await client.fetch_channel(operation["channel_id"])
+        message = channel.get_partial_message(operation["message_id"])
+    except discord.HTTPException:
+        state_store.finish(operation["id"])
+        return
+
+    kind, target = operation["kind"], operation["target"]
+    try:
+        await message_editor.edit(message, embed=EmbedHelper.info("処理を再開しています...", "ボットの再起動で中断された処理を再開しています..."))
+        if kind.startswith("host_"):
+            host = hosts.get(target)
+            if host is None:
+                embed = EmbedHelper.warning("処理を再開できませんでした", f"ホスト `{target}` が見つかりません。")
+            elif kind == "host_off":
+                if await job_scheduler.run(host.job_target, "off", f"{host.label}をシャットダウン", lambda: power_off_host(host), limited=False):
+                    embed = EmbedHelper.success("シャットダウン成功", f"*`{host.label}`*がオフラインになりました。")
+                else:
+                    embed = EmbedHelper.warning("シャットダウンタイムアウト", f"{config.ping_timeout}秒以内に*`{host.label}`*がオフラインになりませんでした。")
+            elif kind == "host_reboot":
+                if host.name not in reboot_boot_ids:
+                    embed = EmbedHelper.warning("処理は中断されました", f"再起動コマンドを送る前にボットが再起動したため、*`{host.label}`*は再起動していません。")
+                elif await job_scheduler.run(host.job_target, "reboot", f"{host.label}を再起動", lambda: wait_for_host_reboot(host), limited=False):
+                    embed = EmbedHelper.success("再起動成功", f"*`{host.label}`*がオンラインになりました。")
+                else:
+                    embed = EmbedHelper.warning("再起動タイムアウト", f"{config.ping_timeout * 2}秒以内に*`{host.label}`*の再起動が完了しませんでした。")
+            elif await job_scheduler.run(host.job_target, "on", f"{host.label}を起動", lambda: power_on_host(host), limited=False):
+                embed = EmbedHelper.success("起動成功", f"*`{host.label}`*がオンラインになりました。")
+            else:
+                embed = EmbedHelper.warning("起動タイムアウト", f"{config.ping_timeout}秒以内に*`{host.label}`*がオンラインになりませんでした。")
+        elif kind.startswith("backup_"):
+            # 低負荷待ちを含め、同じ条件でバックアップをやり直す
+            profiles = [p for p in map(profile_registry.get, target.split(",")) if p]
+            if profiles:
+                await run_backups(message, profiles, kind.removeprefix("backup_"))
+                return
+            embed = EmbedHelper.warning("処理を再開できませんでした", f"サーバー `{target}` が見つかりません。")
+        else:
+            action = kind.removeprefix("server_")
+            profile = profile_registry.get(target)
+            if profile is None:
+                embed = EmbedHelper.warning("処理を再開できませんでした", f"ID `{target}` のサーバーが見つかりません。")
+            elif not await host_for(profile).devices.is_online():
+                embed = EmbedHelper.warning("処理は中断されました", f"*`{host_for(profile).label}`*がオフラインのため{profile['name']}の処理を再開できませんでした。")
+            elif await job_scheduler.run(profile["id"], action, f"{profile['name']}を{constants.content_map[action]['msg']}", lambda: run_server_action(profile, action)):
+                embed = await server_result_embed(profile, action)
+            else:
+                embed = EmbedHelper.warning("初期化タイムアウト", f"{config.ssh_ready_timeout}秒以内に{profile['name']}を起動できませんでした。")
+        await message_editor.edit(message, embed=embed, final=True)
+    except Exception as e:
+        print(f"処理の再開に失敗しました ({kind} {target}): {e}")
+    finally:
+        state_store.finish(operation["id"])
+
+@client.event
+async def setup_hook():
+    """ログイン後、ゲートウェイ接続前の初期化（バックグラウンドタスクの開始とコマンド同期）"""
+    startup_timings["login"] = time.perf_counter() - _started_at
+    pending_operations[:], saved = await state_store.open()
+    server_states.update(saved.get("server_states", {}))
+    reboot_boot_ids.update(saved.get("reboot_boot_ids", {}))
+    for name, boot_time in saved.get("boot_times", {}).items():
+        if name in hosts:
+            hosts[name].devices.boot_time = boot_time
+    try:
+        # systemd の停止（SIGTERM）でも close() を通して状態を保存する
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(client.close()))
+    except NotImplementedError:
+        pass
+    for host in hosts.values():
+        host.start()
+    idle_policy.start()
+    profile_registry.start()
+    perf.instrument_discord()
+    if perf.enabled and config.perf_port:
+        await perf.serve(config.perf_port)
+    # 最初のコマンドを待たせないよう、重いモジュールの読み込みと公開IPの取得を裏で済ませておく
+    asyncio.create_task(asyncio.to_thread(importlib.import_module, "asyncssh"))
+    asyncio.create_task(get_global_ip())
+    if await sync_commands():
+        print("コマンド定義が変更されたため同期しました。")
+
+@client.event
+async def on_connect():
+    startup_timings.setdefault("connect", time.perf_counter() - _started_at)
+
 @client.event
 async def on_ready():
     """ボット起動時の処理"""
-    await client.change_presence()
-    await tree.sync()
+    await presence.apply_now()
     print(f"{client.user} としてログインしました。")
+    if "ready" not in startup_timings:
+        for operation in pending_operations:
+            asyncio.create_task(resume_operation(operation))
+        startup_timings["ready"] = time.perf_counter() - _started_at
+        t = startup_timings
+        print(f"起動時間: import {t['import']:.2f}秒 / ログイン {t['login']:.2f}秒 / "
+              f"ゲートウェイ接続 {t['connect']:.2f}秒 / 準備完了 {t['ready']:.2f}秒 (接続から{(t['ready'] - t['connect']) * 1000:.0f}ミリ秒)")
 
 async def handle_interaction_error(interaction: discord.Interaction, e: Exception):
     """コマンド実行中のエラーを処理し、Embedを送信"""
@@ -220,259 +2433,696 @@ async def handle_interaction_error(interaction: discord.Interaction, e: Exceptio
              print(f"インタラクションへの応答に失敗しました: {e}")
 
 
-async def manage_server(interaction: discord.Interaction, server_id: str, action: str):
-    """ゲームサーバーの start/stop などを共通処理"""
+async def server_autocomplete(interaction: discord.Interaction, current: str) -> List[cmd.Choice[str]]:
+    """サーバーの入力補完（servers.json の再読み込みが即座に反映される）"""
+    current = current.lower()
+    return [cmd.Choice(name=p["name"], value=p["id"]) for p in profile_registry.profiles()
+            if current in p["name"].lower() or current in p["id"].lower()][:25]
+
+async def gsm_server_autocomplete(interaction: discord.Interaction, current: str) -> List[cmd.Choice[str]]:
+    """LinuxGSM サーバーの入力補完"""
+    return [c for c in await server_autocomplete(interaction, current) if profile_registry.get(c.value).get("gsm")]
+
+async def host_autocomplete(interaction: discord.Interaction, current: str) -> List[cmd.Choice[str]]:
+    """ホストの入力補完"""
+    current = current.lower()
+    return [cmd.Choice(name=h.label, value=h.name) for h in hosts.values()
+            if current in h.label.lower() or current in h.name.lower()][:25]
+
+
+async def manage_server(interaction: discord.Interaction, server_ids: List[str], action: str) -> bool:
+    """ゲームサーバーの start/stop などを共通処理（複数指定時は並行して実行）"""
     await interaction.response.defer()
-    
-    profile = next((p for p in constants.profiles if p["id"] == server_id), None)
-    if not profile:
-        await interaction.followup.send(embed=EmbedHelper.error("サーバー未定義", f"ID `{server_id}` のサーバーが見つかりません。"))
-        return
+
+    profiles = []
+    for server_id in dict.fromkeys(s for s in server_ids if s):
+        profile = profile_registry.get(server_id)
+        if not profile:
+            await interaction.followup.send(embed=EmbedHelper.error("サーバー未定義", f"ID `{server_id}` のサーバーが見つかりません。"))
+            return False
+        profiles.append(profile)
 
     try:
         if action == "start":
-            if not await device_manager.is_online():
-                pc_message = await interaction.followup.send(embed=EmbedHelper.info("PC起動中", f"デバイスがオフラインのため起動信号を送信しました。オンラインになるまで待機します... (最大{config.ping_timeout}秒)"))
-                device_manager.send_wol()
-                if not await device_manager.wait_for_online():
-                    await pc_message.edit(embed=EmbedHelper.warning("起動タイムアウト", f"{config.ping_timeout}秒以内に*`MAME G.S.`*がオンラインになりませんでした。"))
-                    return
-                await pc_message.edit(embed=EmbedHelper.success("PC起動完了", "*`MAME G.S.`*がオンラインになりました。"))
+            targets = {host_for(p).name: host_for(p) for p in profiles}
+            if not all(await asyncio.gather(*[ensure_host_online(interaction, host) for host in targets.values()])):
+                return False
+    except Exception as e:
+        await handle_interaction_error(interaction, e)
+        return False
+
+    results = await asyncio.gather(*[manage_single_server(interaction, profile, action) for profile in profiles])
+    return all(results)
 
+
+async def ensure_host_online(interaction: discord.Interaction, host: Host) -> bool:
+    """ホストがオフラインなら起動し、進捗を表示する"""
+    if await host.devices.is_online():
+        return True
+    pc_message = await interaction.followup.send(embed=EmbedHelper.info("PC起動中", f"*`{host.label}`*がオフラインのため起動信号を送信しました。オンラインになるまで待機します... (最大{config.ping_timeout}秒)"))
+    with state_store.track("host_on", host.name, pc_message):
+        if not await job_scheduler.run(host.job_target, "on", f"{host.label}を起動", lambda: power_on_host(host), limited=False):
+            await message_editor.edit(pc_message, embed=EmbedHelper.warning("起動タイムアウト", f"{config.ping_timeout}秒以内に*`{host.label}`*がオンラインになりませんでした。"), final=True)
+            return False
+        await message_editor.edit(pc_message, embed=EmbedHelper.success("PC起動完了", f"*`{host.label}`*がオンラインになりました。"), final=True)
+    return True
+
+
+async def server_result_embed(profile: Dict[str, Any], action: str) -> discord.Embed:
+    """サーバーの start/stop 完了時の Embed を生成（起動時は接続先も表示）"""
+    content = constants.content_map[action]
+    embed = EmbedHelper.create_embed(
+        title=f":{content['emoji']}: {profile['name']}を{content['msg']}しました",
+        description=f"{profile['name']}が{content['msg']}しました",
+        color=content['color']
+    )
+    if action == "start":
+        base_address = profile["info"].get("hostname") or host_for(profile).public_address or await get_global_ip()
+        port = profile["info"].get("port")
+        address = f"{base_address}:{port}" if port else base_address
+        embed.add_field(name="アドレス", value=address, inline=False)
+        if "password" in profile["info"]:
+            embed.add_field(name="パスワード", value=profile["info"]["password"], inline=False)
+    return embed
+
+
+async def manage_single_server(interaction: discord.Interaction, profile: Dict[str, Any], action: str) -> bool:
+    """1台のゲームサーバーに対する処理と進捗表示"""
+    server_message = None
+    try:
         content_initial = constants.content_map[action]
+        status = status_cache.get(profile["id"])
+        if action == "start" and profile.get("gsm") and status is not None and status.session:
+            # LinuxGSM の tmux セッションが見つかっていれば起動済みなのでコマンドを送らない。
+            # プロセスが見つからないことは停止の根拠にならない（独自コマンドのサーバーなど）ため、停止は常に実行する
+            set_server_state(profile["id"], True)
+            embed = await server_result_embed(profile, action)
+            embed.title = f":{content_initial['emoji']}: {profile['name']}は既に{content_initial['msg']}しています"
+            embed.description = f"{profile['name']}は既に{content_initial['msg']}しているため、何もしませんでした。"
+            await interaction.followup.send(embed=embed)
+            return True
+
         server_message = await interaction.followup.send(embed=EmbedHelper.info(f"{profile['name']}を{content_initial['msg']}中...", f"{profile['name']}の{content_initial['msg']}処理を開始します。"))
 
         if action == "start":
-            game_script_path = f"/home/mame/games/{server_id}/gs"
-            await server_message.edit(embed=EmbedHelper.info("初期化待機中", f"起動後の初期化を確認しています... (最大{config.ssh_ready_timeout}秒)"))
-            if not await device_manager.wait_for_ssh_ready(config.ssh_ready_timeout, game_script_path):
+            await message_editor.edit(server_message, embed=EmbedHelper.info("初期化待機中", f"起動後の初期化を確認しています... (最大{config.ssh_ready_timeout}秒)"))
+
+        label = f"{profile['name']}を{content_initial['msg']}"
+        with state_store.track(f"server_{action}", profile["id"], server_message):
+            if not await job_scheduler.run(profile["id"], action, label, lambda: run_server_action(profile, action)):
+                game_script_path = host_for(profile).game_script(profile["id"])
                 desc = (f"{config.ssh_ready_timeout}秒以内に SSH またはゲームスクリプト `{game_script_path}` が利用可能になりませんでした。\n"
                         "しばらく待ってから再度 /start を試してください。")
-                await server_message.edit(embed=EmbedHelper.warning("初期化タイムアウト", desc))
-                return
+                await message_editor.edit(server_message, embed=EmbedHelper.warning("初期化タイムアウト", desc), final=True)
+                return False
 
-        command = f"/home/mame/games/{server_id}/gs {action}" if profile.get("gsm") else profile["command"][action]
-        await remote_client.execute(command)
-
-        content = constants.content_map[action]
-        embed = EmbedHelper.create_embed(
-            title=f":{content['emoji']}: {profile['name']}を{content['msg']}しました",
-            description=f"{profile['name']}が{content['msg']}しました",
-            color=content['color']
-        )
-
-        if action == "start":
-            base_address = profile["info"].get("hostname") or config.global_ip
-            port = profile["info"].get("port")
-            address = f"{base_address}:{port}" if port else base_address
-            embed.add_field(name="アドレス", value=address, inline=False)
-            if "password" in profile["info"]:
-                embed.add_field(name="パスワード", value=profile["info"]["password"], inline=False)
-            await client.change_presence(activity=discord.Game(name=profile["name"]))
-        else:
-            await client.change_presence()
-        
-        await server_message.edit(embed=embed)
+            await message_editor.edit(server_message, embed=await server_result_embed(profile, action), final=True)
+        return True
 
     except Exception as e:
-        await handle_interaction_error(interaction, e)
+        if server_message:
+            await message_editor.edit(server_message, embed=EmbedHelper.error("エラー発生", str(e)), final=True)
+        else:
+            await handle_interaction_error(interaction, e)
+        return False
 
 
 @tree.command(name="start", description="サーバーを起動します")
-@cmd.describe(server="起動するサーバーを選んでください")
-@cmd.choices(server=constants.server_choices)
-async def on_start(interaction: discord.Interaction, server: str):
-    await manage_server(interaction, server, "start")
+@cmd.describe(server="起動するサーバーを選んでください", server2="同時に起動するサーバー (任意)", server3="同時に起動するサーバー (任意)", server4="同時に起動するサーバー (任意)")
+@cmd.autocomplete(server=server_autocomplete, server2=server_autocomplete, server3=server_autocomplete, server4=server_autocomplete)
+async def on_start(interaction: discord.Interaction, server: str, server2: Optional[str] = None, server3: Optional[str] = None, server4: Optional[str] = None):
+    await manage_server(interaction, [server, server2, server3, server4], "start")
 
 @tree.command(name="stop", description="サーバーを停止します")
-@cmd.describe(server="停止するサーバーを選んでください", shutdown="停止後にPCをシャットダウンしますか？ (既定: しない)")
-@cmd.choices(server=constants.server_choices)
-async def on_stop(interaction: discord.Interaction, server: str, shutdown: bool = False):
-    await interaction.response.defer()
-    
-    profile = next((p for p in constants.profiles if p["id"] == server), None)
-    if not profile:
-        await interaction.followup.send(embed=EmbedHelper.error("サーバー未定義", f"ID `{server}` のサーバーが見つかりません。"))
+@cmd.describe(server="停止するサーバーを選んでください", shutdown="停止後にPCをシャットダウンしますか？ (既定: しない)", server2="同時に停止するサーバー (任意)", server3="同時に停止するサーバー (任意)", server4="同時に停止するサーバー (任意)")
+@cmd.autocomplete(server=server_autocomplete, server2=server_autocomplete, server3=server_autocomplete, server4=server_autocomplete)
+async def on_stop(interaction: discord.Interaction, server: str, shutdown: bool = False, server2: Optional[str] = None, server3: Optional[str] = None, server4: Optional[str] = None):
+    if not await manage_server(interaction, [server, server2, server3, server4], "stop") or not shutdown:
         return
 
-    server_message = await interaction.followup.send(embed=EmbedHelper.info(f"{profile['name']}を停止中...", f"{profile['name']}の停止処理を開始します。"))
+    profiles = [p for p in map(profile_registry.get, (server, server2, server3, server4)) if p]
+    targets = {host_for(p).name: host_for(p) for p in profiles}
+    await asyncio.gather(*[shutdown_host(interaction, host) for host in targets.values()])
 
+async def shutdown_host(interaction: discord.Interaction, host: Host):
+    """サーバー停止後にホストをシャットダウンし、結果を表示する"""
     try:
-        command = f"/home/mame/games/{server}/gs stop" if profile.get("gsm") else profile["command"]["stop"]
-        await remote_client.execute(command)
-
-        content = constants.content_map["stop"]
-        embed = EmbedHelper.create_embed(
-            title=f":{content['emoji']}: {profile['name']}を{content['msg']}しました",
-            description=f"{profile['name']}が{content['msg']}しました",
-            color=content['color']
-        )
-        await client.change_presence()
-        await server_message.edit(embed=embed)
+        if not await host.devices.is_online():
+            return
 
-        if shutdown:
-            await asyncio.sleep(5)
-            if not await device_manager.is_online():
-                return
+        pc_message = await interaction.followup.send(embed=EmbedHelper.info("シャットダウン中...", f"サーバー停止完了。*`{host.label}`*のシャットダウンを開始します..."))
+
+        with state_store.track("host_off", host.name, pc_message):
+            if await job_scheduler.run(host.job_target, "off", f"{host.label}をシャットダウン", lambda: power_off_host(host), limited=False):
+                embed = EmbedHelper.success("シャットダウン成功", f"*`{host.label}`*がオフラインになりました。")
+            else:
+                embed = EmbedHelper.warning("シャットダウンタイムアウト", f"{config.ping_timeout}秒以内に*`{host.label}`*がオフラインになりませんでした。")
 
-            pc_message = await interaction.followup.send(embed=EmbedHelper.info("シャットダウン中...", "サーバー停止完了。シャットダウンを開始します..."))
-            
-            await remote_client.execute("sudo poweroff")
+            await message_editor.edit(pc_message, embed=embed, final=True)
+
+    except Exception as e:
+        await handle_interaction_error(interaction, e)
+
+@tree.command(name="players", description="各サーバーの接続人数を表示します")
+async def on_players(interaction: discord.Interaction):
+    await interaction.response.defer()
+    try:
+        profiles = [p for p in profile_registry.profiles() if "query" in p.get("info", {})]
+        if not profiles:
+            await interaction.followup.send(embed=EmbedHelper.info("問い合わせ対象がありません", "`servers.json` の `info.query` に問い合わせ方式を設定してください。"))
+            return
 
-            if await device_manager.wait_for_offline():
-                embed = EmbedHelper.success("シャットダウン成功", "*`MAME G.S.`*がオフラインになりました。")
+        # オフラインのホストに属するサーバーは問い合わせない
+        states = await asyncio.gather(*[h.devices.is_online() for h in hosts.values()])
+        online_hosts = {h.name for h, state in zip(hosts.values(), states) if state}
+        targets = [p for p in profiles if host_for(p).name in online_hosts]
+        results = await game_query.query_all(targets)
+
+        embed = EmbedHelper.create_embed(":busts_in_silhouette: 接続人数", "各サーバーへの接続人数です。", constants.content_map["gsm"]["color"])
+        for profile in profiles:
+            result = results.get(profile["id"])
+            if result is None:
+                value = ":red_circle: デバイスがオフラインです"
+            elif result.misconfigured:
+                value = f":warning: 問い合わせ設定を確認してください ({result.error})"
+            elif not result.online:
+                value = ":red_circle: 応答なし"
             else:
-                embed = EmbedHelper.warning("シャットダウンタイムアウト", f"{config.ping_timeout}秒以内に*`MAME G.S.`*がオフラインになりませんでした。")
-            
-            await pc_message.edit(embed=embed)
+                count = "?" if result.players is None else str(result.players)
+                value = f":green_circle: {count}" + (f" / {result.max_players}人" if result.max_players is not None else "人")
+                if result.names:
+                    value += "\n" + ", ".join(result.names[:10])
+            embed.add_field(name=profile["name"], value=value, inline=True)
+        await interaction.followup.send(embed=embed)
 
     except Exception as e:
         await handle_interaction_error(interaction, e)
 
+@tree.command(name="idle", description="自動停止の状況と履歴を表示します")
+async def on_idle(interaction: discord.Interaction):
+    if not idle_policy.enabled:
+        await interaction.response.send_message(embed=EmbedHelper.info("自動停止は無効です", "`IDLE_CHANNEL_ID` を設定すると有効になります。"))
+        return
+
+    now = time.monotonic()
+    embed = EmbedHelper.create_embed(":zzz: 自動停止", f"{idle_policy.idle_timeout // 60}分間誰も遊んでいないサーバーを停止します。", constants.content_map["gsm"]["color"])
+    for profile in profile_registry.profiles():
+        if server_states.get(profile["id"]):
+            since = idle_policy.idle_since.get(profile["id"])
+            value = f"無人 {int(now - since) // 60}分" if since is not None else "稼働中"
+            embed.add_field(name=profile["name"], value=value, inline=True)
+    history = "\n".join(f"<t:{int(ts)}:t> {text}" for ts, text in list(idle_policy.audit)[-10:])
+    embed.add_field(name="履歴", value=history or "（なし）", inline=False)
+    await interaction.response.send_message(embed=embed)
+
+@tree.command(name="jobs", description="待機中・実行中の処理を表示します")
+async def on_jobs(interaction: discord.Interaction):
+    jobs = job_scheduler.jobs()
+    if not jobs:
+        await interaction.response.send_message(embed=EmbedHelper.info("処理はありません", "待機中・実行中の処理はありません。"))
+        return
+
+    now = time.time()
+    embed = EmbedHelper.create_embed(":hourglass: 処理一覧", f"{len(jobs)}件の処理があります。", constants.content_map["gsm"]["color"])
+    for job in jobs:
+        if job.started_at:
+            state = f"実行中 ({now - job.started_at:.0f}秒経過)"
+        else:
+            state = f"待機中 ({now - job.created_at:.0f}秒経過)"
+        embed.add_field(name=job.label, value=f"{state} / 待機者 {job.waiters}人", inline=False)
+    await interaction.response.send_message(embed=embed)
+
+@tree.command(name="perf", description="処理段階ごとの所要時間を表示します")
+@cmd.describe(reset="表示後に集計をリセットする")
+@cmd.default_permissions(administrator=True)
+async def on_perf(interaction: discord.Interaction, reset: bool = False):
+    if not perf.enabled:
+        await interaction.response.send_message(embed=EmbedHelper.info("計測は無効です", "`PERF_ENABLED=0` が設定されています。"), ephemeral=True)
+        return
+
+    embed = EmbedHelper.create_embed(":stopwatch: 処理時間", f"<t:{int(perf.since)}:f> からの集計です。", constants.content_map["gsm"]["color"])
+    for stage, h in sorted(perf.stages.items())[:25]:
+        value = (f"{h.count}回 / 平均 {h.total / h.count:.3f}秒\n"
+                 f"p50 {h.quantile(0.5):.3f}秒 / p95 {h.quantile(0.95):.3f}秒 / 最大 {h.max:.3f}秒")
+        if h.errors:
+            value += f"\nエラー {h.errors}回"
+        embed.add_field(name=stage, value=value, inline=True)
+    if not perf.stages:
+        embed.description += "\nまだ記録がありません。"
+    if reset:
+        perf.reset()
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @tree.command(name="gsm", description="LinuxGSMサーバーを管理します")
 @cmd.describe(server="操作するサーバーを選んでください", action="実行するアクションを選んでください")
-@cmd.choices(server=constants.gsm_server_choices, action=constants.action_choices)
+@cmd.autocomplete(server=gsm_server_autocomplete)
+@cmd.choices(action=constants.action_choices)
 async def on_gsm(interaction: discord.Interaction, server: str, action: str):
     await interaction.response.defer()
     try:
-        command = f"/home/mame/games/{server}/gs {action}"
-        output = await remote_client.execute(command)
-        true_output = re.sub(r'\x1B\[[0-?]*[ -/]*[@-~]', '', output)
-        
-        embed = EmbedHelper.create_embed(
-            title=f":desktop: コマンド実行成功",
-            description=f"`{server}` でコマンド `{action}` を実行しました。",
-            color=constants.content_map["gsm"]["color"]
-        )
+        profile = profile_registry.get(server)
+        if not profile or not profile.get("gsm"):
+            await interaction.followup.send(embed=EmbedHelper.error("サーバー未定義", f"ID `{server}` のサーバーが見つかりません。"))
+            return
+        host = host_for(profile)
+        command = f"{host.game_script(server)} {action}"
+        message = await interaction.followup.send(embed=EmbedHelper.info("コマンド実行中...", f"`{server}` でコマンド `{action}` を実行しています..."))
+        output = OutputBuffer()
+        error: Optional[Exception] = None
+        dirty = False
+
+        async def _update_progress():
+            # 出力の末尾を一定間隔でメッセージに反映する
+            nonlocal dirty
+            while True:
+                await asyncio.sleep(constants.gsm_edit_interval)
+                if dirty:
+                    dirty = False
+                    embed = EmbedHelper.info("コマンド実行中...", f"`{server}` でコマンド `{action}` を実行しています...")
+                    embed.add_field(name="出力", value=f"```{output.tail(1000) or '…'}```")
+                    await message_editor.edit(message, embed=embed)
+
+        updater = asyncio.create_task(_update_progress())
+        try:
+            async for line in host.remote.stream(command):
+                output.append(ANSI_ESCAPE.sub('', line).rsplit('\r', 1)[-1])
+                dirty = True
+        except ConnectionError as e:
+            error = e
+        finally:
+            updater.cancel()
+            if action in ("start", "stop", "restart"):
+                status_cache.invalidate(profile)
+                if error is None:
+                    set_server_state(server, action != "stop")
+
+        if error:
+            embed = EmbedHelper.error("コマンド実行失敗", f"`{server}` でコマンド `{action}` が失敗しました。\n{error}")
+        else:
+            embed = EmbedHelper.create_embed(
+                title=f":desktop: コマンド実行成功",
+                description=f"`{server}` でコマンド `{action}` を実行しました。",
+                color=constants.content_map["gsm"]["color"]
+            )
 
+        true_output = output.text()
         if len(true_output) > 1024:
-            with open("log.txt", "w", encoding="utf-8") as f:
-                f.write(true_output)
-            await interaction.followup.send(embed=embed, file=discord.File("log.txt"))
-            os.remove("log.txt")
+            log = discord.File(io.BytesIO(true_output.encode("utf-8")), filename=f"{server}-{action}.log")
+            await message_editor.edit(message, embed=embed, attachments=[log], final=True)
         else:
             embed.add_field(name="実行結果", value=f"```{true_output or '（出力なし）'}```")
+            await message_editor.edit(message, embed=embed, final=True)
+
+    except Exception as e:
+        await handle_interaction_error(interaction, e)
+
+def build_log_command(log_dir: str, pattern: Optional[str], lines: int, follow: bool) -> str:
+    """ログの絞り込みをホスト側で行うシェルコマンドを組み立てる"""
+    # 更新が新しい数ファイルだけを対象にし、最後の tail で最新の行が残るよう古い順に並べ直す
+    files = (f"find {shlex.quote(log_dir)} -type f -name '*.log' -printf '%T@ %p\\n' | sort -rn "
+             f"| head -n {constants.log_max_files} | sort -n | cut -d' ' -f2-")
+    grep = f"grep -a -i -E --line-buffered -e {shlex.quote(pattern)}" if pattern else "cat"
+    if follow:
+        return f"{files} | xargs -r -d '\\n' timeout {constants.log_follow_duration} tail -q -n 0 -F 2>/dev/null | {grep}"
+    scan = (f"{files} | while read -r f; do tail -n {constants.log_scan_lines} \"$f\" | nice -n 10 {grep} "
+            f"| sed \"s|^|${{f##*/}}: |\"; done")
+    return f"{scan} | tail -n {lines} | gzip -c"
+
+
+async def follow_logs(interaction: discord.Interaction, message: discord.Message, host: Host, profile: Dict[str, Any], pattern: Optional[str]):
+    """新しいログ行をスレッドへまとめて送信する"""
+    try:
+        destination = await message.create_thread(name=f"{profile['name']} のログ")
+    except (discord.HTTPException, AttributeError, ValueError):
+        destination = interaction.channel
+
+    # 出力の多いログでもメモリと投稿数が増え続けないよう、保持する行数と1回に送るメッセージ数を制限する
+    pending: deque = deque(maxlen=constants.log_follow_max_lines)
+    skipped = 0
+    done = asyncio.Event()
+    error: List[Exception] = []
+    started = time.monotonic()
+
+    async def _read():
+        nonlocal skipped
+        try:
+            async for line in host.remote.stream(build_log_command(f"{host.game_dir(profile['id'])}/log", pattern, 0, follow=True)):
+                if len(pending) == pending.maxlen:
+                    skipped += 1
+                pending.append(ANSI_ESCAPE.sub('', line))
+        except ConnectionError as e:
+            # timeout による終了も非ゼロ終了コードになるため、中断かどうかは経過時間で判断する
+            error.append(e)
+        finally:
+            done.set()
+
+    reader = asyncio.create_task(_read())
+    try:
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), timeout=constants.log_follow_interval)
+            except asyncio.TimeoutError:
+                pass
+            # 一定間隔でまとめて送り、1メッセージの上限を超える分は切り詰め、送りきれない分は省略する
+            note = [f"…（{skipped}行省略）"] if skipped and pending else []
+            if note:
+                skipped = 0
+            for _ in range(constants.log_follow_messages):
+                if not pending:
+                    break
+                chunk, note = note, []
+                size = sum(len(line) + 1 for line in chunk)
+                while pending and size + len(pending[0]) + 1 <= 1900:
+                    line = pending.popleft()
+                    chunk.append(line)
+                    size += len(line) + 1
+                if not chunk:
+                    chunk.append(pending.popleft()[:1900])
+                await destination.send(f"```{chr(10).join(chunk)}```")
+            skipped += len(pending)
+            pending.clear()
+    finally:
+        reader.cancel()
+    if skipped:
+        await destination.send(f"```…（{skipped}行省略）```")
+    elapsed = time.monotonic() - started
+    if elapsed >= constants.log_follow_duration:
+        embed = EmbedHelper.info("ログの追跡を終了しました", f"{constants.log_follow_duration}秒が経過したため追跡を終了しました。")
+    else:
+        reason = f"\n{error[0]}" if error else "\n追跡できるログファイルがありません。"
+        embed = EmbedHelper.warning("ログの追跡が中断されました", f"{elapsed:.0f}秒で追跡が終了しました。{reason}")
+    await destination.send(embed=embed)
+
+
+@tree.command(name="logs", description="サーバーのログを検索・表示します")
+@cmd.describe(server="対象のサーバーを選んでください", pattern="絞り込む文字列（正規表現、大文字小文字を区別しない）", lines="表示する行数 (既定: 50)", follow="新しいログをスレッドに流し続けますか？ (既定: しない)")
+@cmd.autocomplete(server=gsm_server_autocomplete)
+async def on_logs(interaction: discord.Interaction, server: str, pattern: Optional[str] = None, lines: cmd.Range[int, 1, 1000] = 50, follow: bool = False):
+    await interaction.response.defer()
+    try:
+        profile = profile_registry.get(server)
+        if not profile:
+            await interaction.followup.send(embed=EmbedHelper.error("サーバー未定義", f"ID `{server}` のサーバーが見つかりません。"))
+            return
+        host = host_for(profile)
+        if not await host.devices.is_online():
+            await interaction.followup.send(embed=EmbedHelper.info("デバイスはオフラインです", "オフラインのためログを取得できません。"))
+            return
+
+        condition = f"`{pattern}` に一致する" if pattern else ""
+        if follow:
+            message = await interaction.followup.send(embed=EmbedHelper.info(f"{profile['name']}のログを追跡中...", f"{condition}新しいログを{constants.log_follow_duration}秒間スレッドに送信します。"))
+            await follow_logs(interaction, message, host, profile, pattern)
+            return
+
+        compressed = await host.remote.execute_bytes(build_log_command(f"{host.game_dir(server)}/log", pattern, lines, follow=False))
+        output = ANSI_ESCAPE.sub('', gzip.decompress(compressed).decode("utf-8", errors="replace")) if compressed else ""
+
+        embed = EmbedHelper.create_embed(f":scroll: {profile['name']}のログ", f"{condition}直近{lines}行です。", constants.content_map["gsm"]["color"])
+        if len(output) > 1024:
+            embed.set_footer(text=f"転送量 {len(compressed):,} バイト（展開後 {len(output.encode('utf-8')):,} バイト）")
+            await interaction.followup.send(embed=embed, file=discord.File(io.BytesIO(output.encode("utf-8")), filename=f"{server}.log"))
+        else:
+            embed.add_field(name="ログ", value=f"```{output or '（該当なし）'}```")
             await interaction.followup.send(embed=embed)
 
     except Exception as e:
         await handle_interaction_error(interaction, e)
 
+async def run_backups(message: discord.Message, profiles: List[Dict[str, Any]], schedule: str):
+    """複数サーバーのバックアップを並行して実行し、進捗と結果をメッセージに表示する"""
+    states = {p["id"]: "待機中" for p in profiles}
+    dirty = False
+
+    def _render(title: str, description: str) -> discord.Embed:
+        embed = EmbedHelper.create_embed(title, description, constants.content_map["gsm"]["color"])
+        for p in profiles:
+            embed.add_field(name=p["name"], value=states[p["id"]], inline=False)
+        return embed
+
+    def _set_state(server_id: str, text: str):
+        nonlocal dirty
+        states[server_id] = text
+        dirty = True
+
+    await message_editor.edit(message, embed=_render(":floppy_disk: バックアップ中...", f"{len(profiles)}台のサーバーのバックアップを開始します。"))
+
+    async def _update_progress():
+        nonlocal dirty
+        while True:
+            await asyncio.sleep(constants.gsm_edit_interval)
+            if dirty:
+                dirty = False
+                await message_editor.edit(message, embed=_render(":floppy_disk: バックアップ中...", "サーバーは停止せずにバックアップしています。"))
+
+    async def _backup(profile: Dict[str, Any]) -> BackupResult:
+        host = host_for(profile)
+        if schedule == "low_load":
+            # 待機も /jobs に表示する。サーバーの起動/停止は妨げないよう別の対象として並べる
+            def _wait(cpu: float):
+                _set_state(profile["id"], f"低負荷になるのを待っています (CPU {cpu:.0f}%)")
+            if not await job_scheduler.run(f"backup:{profile['id']}", "wait", f"{profile['name']}のバックアップ（低負荷待ち）",
+                                           lambda: backup_manager.wait_for_low_load(host, _wait), limited=False, share=False):
+                _set_state(profile["id"], "低負荷にならなかったため開始します")
+
+        def _progress(percent: Optional[float]):
+            _set_state(profile["id"], "実行中..." if percent is None else f"実行中... {percent:.0f}%")
+
+        # 同じサーバーの起動/停止とは同時に行わない。進捗は呼び出し元ごとに表示するため相乗りはしない
+        return await job_scheduler.run(profile["id"], "backup", f"{profile['name']}をバックアップ",
+                                       lambda: backup_manager.run(profile, _progress), limited=False, share=False)
+
+    updater = asyncio.create_task(_update_progress())
+    try:
+        results = await asyncio.gather(*[_backup(p) for p in profiles])
+    finally:
+        updater.cancel()
+
+    mb = 1024**2
+    for profile, result in zip(profiles, results):
+        duration = f"{int(result.duration) // 60}分{int(result.duration) % 60}秒"
+        if result.status == "created":
+            states[profile["id"]] = f":white_check_mark: {result.size / mb:,.0f} MB ({duration})\n`{result.path}`"
+        elif result.status == "duplicate":
+            states[profile["id"]] = f":recycle: 前回から変更がないため保存しませんでした ({duration})\n`{result.path}`"
+        else:
+            states[profile["id"]] = f":x: 失敗しました ({duration})\n```{(result.error or '不明なエラー')[-900:]}```"
+    failed = sum(r.status == "failed" for r in results)
+    total = sum(r.size for r in results if r.status == "created")
+    title = ":floppy_disk: バックアップ完了" if not failed else f":warning: {failed}台のバックアップに失敗しました"
+    await message_editor.edit(message, embed=_render(title, f"新しいアーカイブ 合計 {total / mb:,.0f} MB / 各サーバー最新{backup_manager.keep}個を保持"), final=True)
+
+@tree.command(name="backup", description="サーバーのバックアップを作成します")
+@cmd.describe(server="バックアップするサーバーを選んでください", server2="同時にバックアップするサーバー (任意)", server3="同時にバックアップするサーバー (任意)",
+              server4="同時にバックアップするサーバー (任意)", schedule="実行するタイミングを選んでください (既定: 今すぐ)")
+@cmd.autocomplete(server=server_autocomplete, server2=server_autocomplete, server3=server_autocomplete, server4=server_autocomplete)
+@cmd.choices(schedule=constants.backup_schedule_choices)
+async def on_backup(interaction: discord.Interaction, server: str, server2: Optional[str] = None, server3: Optional[str] = None, server4: Optional[str] = None, schedule: str = "now"):
+    await interaction.response.defer()
+    message = None
+    try:
+        profiles = []
+        for server_id in dict.fromkeys(s for s in (server, server2, server3, server4) if s):
+            profile = profile_registry.get(server_id)
+            if not profile:
+                await interaction.followup.send(embed=EmbedHelper.error("サーバー未定義", f"ID `{server_id}` のサーバーが見つかりません。"))
+                return
+            profiles.append(profile)
+        targets = {host_for(p).name: host_for(p) for p in profiles}
+        for target in targets.values():
+            if not await target.devices.is_online():
+                await interaction.followup.send(embed=EmbedHelper.info("デバイスはオフラインです", f"*`{target.label}`*がオフラインのためバックアップできません。"))
+                return
+
+        # 低負荷待ちや大きなサーバーではインタラクションの有効期限（15分）を過ぎるため、
+        # 進捗と結果はボットのトークンでチャンネルに投稿したメッセージに表示する
+        await interaction.followup.send(embed=EmbedHelper.info("バックアップを開始しました", f"{len(profiles)}台のサーバーの進捗をこのチャンネルに表示します。"))
+        message = await interaction.channel.send(embed=EmbedHelper.info("バックアップ中...", f"{len(profiles)}台のサーバーのバックアップを開始します。"))
+        with state_store.track(f"backup_{schedule}", ",".join(p["id"] for p in profiles), message):
+            await run_backups(message, profiles, schedule)
+
+    except Exception as e:
+        if message:
+            await message_editor.edit(message, embed=EmbedHelper.error("エラー発生", str(e)), final=True)
+        else:
+            await handle_interaction_error(interaction, e)
+
 @tree.command(name="on", description="デバイスを起動します")
-async def on_power_on(interaction: discord.Interaction):
+@cmd.describe(host="起動するデバイスを選んでください (既定: 最初のデバイス)")
+@cmd.autocomplete(host=host_autocomplete)
+async def on_power_on(interaction: discord.Interaction, host: Optional[str] = None):
     await interaction.response.defer()
     try:
-        if await device_manager.is_online():
-            await interaction.followup.send(embed=EmbedHelper.info("デバイスはオンラインです", "*`MAME G.S.`*は既にオンラインです。"))
+        target = get_host(host)
+        if await target.devices.is_online():
+            await interaction.followup.send(embed=EmbedHelper.info("デバイスはオンラインです", f"*`{target.label}`*は既にオンラインです。"))
             return
 
         message = await interaction.followup.send(embed=EmbedHelper.info("デバイス起動中...", "起動信号を送信しました。オンラインになるまで待機します..."))
-        device_manager.send_wol()
-        
-        if await device_manager.wait_for_online():
-            await message.edit(embed=EmbedHelper.success("起動成功", "*`MAME G.S.`*がオンラインになりました。"))
-        else:
-            await message.edit(embed=EmbedHelper.warning("起動タイムアウト", f"{config.ping_timeout}秒以内に*`MAME G.S.`*がオンラインになりませんでした。"))
+
+        with state_store.track("host_on", target.name, message):
+            if await job_scheduler.run(target.job_target, "on", f"{target.label}を起動", lambda: power_on_host(target), limited=False):
+                await message_editor.edit(message, embed=EmbedHelper.success("起動成功", f"*`{target.label}`*がオンラインになりました。"), final=True)
+            else:
+                await message_editor.edit(message, embed=EmbedHelper.warning("起動タイムアウト", f"{config.ping_timeout}秒以内に*`{target.label}`*がオンラインになりませんでした。"), final=True)
 
     except Exception as e:
         await handle_interaction_error(interaction, e)
 
 @tree.command(name="off", description="デバイスをシャットダウンします")
-async def on_power_off(interaction: discord.Interaction):
+@cmd.describe(host="シャットダウンするデバイスを選んでください (既定: 最初のデバイス)")
+@cmd.autocomplete(host=host_autocomplete)
+async def on_power_off(interaction: discord.Interaction, host: Optional[str] = None):
     await interaction.response.defer()
     try:
-        if not await device_manager.is_online():
-            await interaction.followup.send(embed=EmbedHelper.info("デバイスはオフラインです", "*`MAME G.S.`*は既にオフラインです。"))
+        target = get_host(host)
+        if not await target.devices.is_online():
+            await interaction.followup.send(embed=EmbedHelper.info("デバイスはオフラインです", f"*`{target.label}`*は既にオフラインです。"))
             return
 
         message = await interaction.followup.send(embed=EmbedHelper.info("シャットダウン中...", "シャットダウンを開始します。完了までお待ちください..."))
-        
-        await remote_client.execute("sudo poweroff")
 
-        if await device_manager.wait_for_offline():
-            embed = EmbedHelper.success("シャットダウン成功", "*`MAME G.S.`*がオフラインになりました。")
-        else:
-            embed = EmbedHelper.warning("シャットダウンタイムアウト", f"{config.ping_timeout}秒以内に*`MAME G.S.`*がオフラインになりませんでした。")
-        
-        await message.edit(embed=embed)
+        with state_store.track("host_off", target.name, message):
+            if await job_scheduler.run(target.job_target, "off", f"{target.label}をシャットダウン", lambda: power_off_host(target), limited=False):
+                embed = EmbedHelper.success("シャットダウン成功", f"*`{target.label}`*がオフラインになりました。")
+            else:
+                embed = EmbedHelper.warning("シャットダウンタイムアウト", f"{config.ping_timeout}秒以内に*`{target.label}`*がオフラインになりませんでした。")
+
+            await message_editor.edit(message, embed=embed, final=True)
 
     except Exception as e:
         await handle_interaction_error(interaction, e)
 
 @tree.command(name="reboot", description="デバイスを再起動します")
-async def on_reboot(interaction: discord.Interaction):
+@cmd.describe(host="再起動するデバイスを選んでください (既定: 最初のデバイス)")
+@cmd.autocomplete(host=host_autocomplete)
+async def on_reboot(interaction: discord.Interaction, host: Optional[str] = None):
     await interaction.response.defer()
     try:
-        if not await device_manager.is_online():
+        target = get_host(host)
+        if not await target.devices.is_online():
             await interaction.followup.send(embed=EmbedHelper.info("デバイスはオフラインです", "オフラインのため再起動できません。"))
             return
 
-        message = await interaction.followup.send(embed=EmbedHelper.info("再起動中...", "再起動コマンドを送信しました。デバイスがオンラインになるまで待機します..."))
-        await remote_client.execute("sudo reboot")
-
-        # オフライン->オンラインになるのを待つ
-        await asyncio.sleep(10) # シャットダウンシーケンスのための待機
-        await message.edit(embed=EmbedHelper.info("再起動中...", "デバイスのシャットダウンを待っています..."))
-        await device_manager.wait_for_offline()
-
-        await message.edit(embed=EmbedHelper.info("再起動中...", "デバイスの再起動を待っています..."))
-        if await device_manager.wait_for_online():
-            embed = EmbedHelper.success("再起動成功", "*`MAME G.S.`*がオンラインになりました。")
-        else:
-            embed = EmbedHelper.warning("再起動タイムアウト", f"{config.ping_timeout}秒以内に*`MAME G.S.`*がオンラインになりませんでした。")
+        message = await interaction.followup.send(embed=EmbedHelper.info("再起動中...", "デバイスを再起動しています。オンラインに戻るまで待機します..."))
+        with state_store.track("host_reboot", target.name, message):
+            # 同じホストへの電源操作と直列化し、同時に実行された /reboot は1回の再起動にまとめる
+            if await job_scheduler.run(target.job_target, "reboot", f"{target.label}を再起動", lambda: reboot_host(target), limited=False):
+                embed = EmbedHelper.success("再起動成功", f"*`{target.label}`*がオンラインになりました。")
+            else:
+                embed = EmbedHelper.warning("再起動タイムアウト", f"{config.ping_timeout * 2}秒以内に*`{target.label}`*の再起動が完了しませんでした。")
 
-        await message.edit(embed=embed)
+            await message_editor.edit(message, embed=embed, final=True)
 
     except Exception as e:
         await handle_interaction_error(interaction, e)
 
+def server_status_text(profile: Dict[str, Any]) -> str:
+    """キャッシュ済みのサーバーの状態を1行で返す"""
+    status = status_cache.get(profile["id"])
+    if status is None:
+        return ":grey_question: 確認中"
+    if not status.running:
+        # 独自コマンドのサーバーはディレクトリ外で動くことがあり、プロセスが見つからなくても停止中とは限らない
+        return ":white_circle: 停止中" if profile.get("gsm") else ":grey_question: 不明（プロセスを検出できません）"
+    pid = f"PID {status.pid} / " if status.pid else ""
+    return f":green_circle: 稼働中 ({pid}CPU {status.cpu:.0f}% / メモリ {status.rss / 1024**3:.1f} GB)"
+
 @tree.command(name="status", description="デバイスのオンライン状態を確認します")
-async def on_status(interaction: discord.Interaction):
+@cmd.describe(host="確認するデバイスを選んでください (既定: すべて)")
+@cmd.autocomplete(host=host_autocomplete)
+async def on_status(interaction: discord.Interaction, host: Optional[str] = None):
     await interaction.response.defer()
-    if await device_manager.is_online():
-        embed = EmbedHelper.create_embed(":green_circle: オンライン", "*`MAME G.S.`*は現在オンラインです。", 0x00ff00)
-    else:
-        embed = EmbedHelper.create_embed(":red_circle: オフライン", "*`MAME G.S.`*は現在オフラインです。", 0xff0000)
-    await interaction.followup.send(embed=embed)
+    try:
+        targets = [get_host(host)] if host else list(hosts.values())
+        states = await asyncio.gather(*[t.devices.is_online() for t in targets])
+        if len(targets) == 1:
+            if states[0]:
+                embed = EmbedHelper.create_embed(":green_circle: オンライン", f"*`{targets[0].label}`*は現在オンラインです。", 0x00ff00)
+                # サーバーごとの状態は収集済みのキャッシュから表示する（SSH は呼ばない）
+                for profile in profile_registry.for_host(targets[0].name)[:24]:
+                    embed.add_field(name=profile["name"], value=server_status_text(profile), inline=True)
+            else:
+                embed = EmbedHelper.create_embed(":red_circle: オフライン", f"*`{targets[0].label}`*は現在オフラインです。", 0xff0000)
+        else:
+            online = sum(states)
+            embed = EmbedHelper.create_embed(":satellite: デバイス状態", f"{len(targets)}台中{online}台がオンラインです。", 0x00ff00 if online else 0xff0000)
+            for target, state in zip(targets[:25], states):
+                value = ":green_circle: オンライン" if state else ":red_circle: オフライン"
+                if state:
+                    value += "".join(f"\n{p['name']}: {server_status_text(p)}" for p in profile_registry.for_host(target.name))
+                embed.add_field(name=target.label, value=value[:1024], inline=False)
+        await interaction.followup.send(embed=embed)
+
+    except Exception as e:
+        await handle_interaction_error(interaction, e)
 
 @tree.command(name="stats", description="サーバーのリソース使用状況を表示します")
-async def on_stats(interaction: discord.Interaction):
+@cmd.describe(mode="表示内容を選んでください (既定: 現在)", period="履歴の表示期間を選んでください (既定: 1時間)", host="対象のデバイスを選んでください (既定: すべて)")
+@cmd.choices(mode=constants.stats_mode_choices, period=constants.history_period_choices)
+@cmd.autocomplete(host=host_autocomplete)
+async def on_stats(interaction: discord.Interaction, mode: str = "current", period: str = "1h", host: Optional[str] = None):
     await interaction.response.defer()
     try:
-        if not await device_manager.is_online():
-            await interaction.followup.send(embed=EmbedHelper.info("デバイスはオフラインです", "オフラインのため情報を取得できません。"))
+        if mode == "history":
+            await send_stats_history(interaction, get_host(host), period)
             return
 
-        cmds = {
-            "cpu": "top -bn1 | grep '%Cpu' | awk '{print 100 - $8}'",
-            "mem": "free -b | awk 'NR==2 { printf \"%f %f\", $3, $2 }'",
-            "disk": "df -B1 / | awk 'NR==2 { printf \"%f %f\", $3, $2 }'",
-            "uptime": "uptime -p"
-        }
-        
-        results = await asyncio.gather(*[remote_client.execute(cmd) for cmd in cmds.values()])
-        cpu_usage, mem_raw, disk_raw, uptime_raw = results
-
-        mem_used, mem_total = map(float, mem_raw.split())
-        disk_used, disk_total = map(float, disk_raw.split())
-
-        uptime_jp = (
-            uptime_raw.replace("up ", "").replace(" hours", "時間").replace(" hour", "時間")
-            .replace(" minutes", "分").replace(" minute", "分").replace(", ", "")
-        )
-
-        gb = 1024**3
-        embed = EmbedHelper.create_embed(title=":chart_with_upwards_trend: システム状況", description="*`MAME G.S.`*の現在のリソース使用率です。", color=0x00ff00)
-        embed.add_field(name="CPU使用率", value=f"{float(cpu_usage):.1f}%", inline=True)
-        embed.add_field(name="メモリ使用量", value=f"{mem_used/gb:.1f} GB / {mem_total/gb:.1f} GB ({mem_used*100/mem_total:.1f}%)", inline=True)
-        embed.add_field(name="\u200b", value="\u200b", inline=True) # Spacer
-        embed.add_field(name="ディスク使用量", value=f"{disk_used/gb:.1f} GB / {disk_total/gb:.1f} GB ({disk_used*100/disk_total:.1f}%)", inline=True)
-        embed.add_field(name="稼働時間", value=uptime_jp.strip(), inline=True)
+        targets = [get_host(host)] if host else list(hosts.values())
+        states = await asyncio.gather(*[t.devices.is_online() for t in targets])
+        online = [t for t, state in zip(targets, states) if state]
+        if not online:
+            await interaction.followup.send(embed=EmbedHelper.info("デバイスはオフラインです", "オフラインのため情報を取得できません。"))
+            return
 
-        await interaction.followup.send(embed=embed)
+        # 全ホストのメトリクスを並行して取得し、1つの応答にまとめる
+        results = await asyncio.gather(*[t.metrics.collect() for t in online], return_exceptions=True)
+        embeds = []
+        for target, metrics in zip(online, results):
+            if isinstance(metrics, Exception):
+                embeds.append(EmbedHelper.error(f"{target.label}の情報取得に失敗しました", str(metrics)))
+                continue
+
+            gb = 1024**3
+            embed = EmbedHelper.create_embed(title=":chart_with_upwards_trend: システム状況", description=f"*`{target.label}`*の現在のリソース使用率です。", color=0x00ff00)
+            embed.add_field(name="CPU使用率", value=f"{metrics.cpu:.1f}%", inline=True)
+            embed.add_field(name="メモリ使用量", value=f"{metrics.mem_used/gb:.1f} GB / {metrics.mem_total/gb:.1f} GB ({metrics.mem_percent:.1f}%)", inline=True)
+            embed.add_field(name="ロードアベレージ", value=" / ".join(f"{v:.2f}" for v in metrics.load), inline=True)
+            embed.add_field(name="ディスク使用量", value=f"{metrics.disk_used/gb:.1f} GB / {metrics.disk_total/gb:.1f} GB ({metrics.disk_percent:.1f}%)", inline=True)
+            embed.add_field(name="稼働時間", value=metrics.uptime_text(), inline=True)
+            pool = target.remote.pool_stats()
+            embed.set_footer(text=f"SSH接続 {pool['connections']}本 / 累計接続 {pool['connects']}回 / 実行コマンド {pool['commands']}件")
+            embeds.append(embed)
+        for target in targets:
+            if target not in online:
+                embeds.append(EmbedHelper.info("デバイスはオフラインです", f"*`{target.label}`*はオフラインのため情報を取得できません。"))
+
+        await interaction.followup.send(embeds=embeds[:10])
 
     except Exception as e:
         await handle_interaction_error(interaction, e)
 
+async def send_stats_history(interaction: discord.Interaction, host: Host, period: str):
+    """記録済みのメトリクス履歴をグラフ画像として送信"""
+    labels = {"cpu": ("CPU使用率", "赤", (0xff, 0x63, 0x47)), "mem": ("メモリ使用率", "青", (0x1e, 0x90, 0xff)), "disk": ("ディスク使用率", "緑", (0x32, 0xcd, 0x32))}
+    tier = host.history.tiers[period]
+    series = {name: host.history.series(period, name) for name in labels}
+    if not series["cpu"]:
+        await interaction.followup.send(embed=EmbedHelper.info("履歴がありません", "まだメトリクスが記録されていません。デバイスがオンラインの間に記録されます。"))
+        return
+
+    end = time.time()
+    png = ChartHelper.line_chart([(series[name], label[2]) for name, label in labels.items()], end - tier["span"], end, gap=tier["step"] * 3)
+    embed = EmbedHelper.create_embed(title=":chart_with_upwards_trend: システム状況の推移", description=f"*`{host.label}`*の{constants.history_periods[period]['label']}のリソース使用率です。", color=0x00ff00)
+    for name, (label, color_name, _) in labels.items():
+        values = [v for _, v in series[name]]
+        embed.add_field(name=f"{label} ({color_name})", value=f"平均 {sum(values)/len(values):.1f}% / 最大 {max(values):.1f}%", inline=True)
+    embed.set_image(url="attachment://stats.png")
+    embed.set_footer(text=f"サンプル数 {len(series['cpu'])} / 間隔 {tier['step']}秒")
+    await interaction.followup.send(embed=embed, file=discord.File(io.BytesIO(png), filename="stats.png"))
+
+startup_timings["import"] = time.perf_counter() - _started_at
+
 def main():
     """メインループ"""
     if not config.discord_token: